@@ -0,0 +1,109 @@
+"""Times the JSON backend used by minifier.load, create_endpoint_files and count_tokens_in_directory.
+
+Builds a multi-MB spec, then compares the stdlib json.load / json.dump calls with json_loads / json_dumps
+and checks that the written bytes are identical.
+
+    python benchmarks/json_backend.py --endpoints 3000
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import minifier
+
+
+def build_spec(endpoint_count):
+    schemas = {}
+    for index in range(endpoint_count // 4 + 1):
+        schemas[f'Schema{index}'] = {
+            'type': 'object',
+            'description': f'Schema number {index} with a <b>description</b> and unicode éè',
+            'properties': {
+                f'field{field}': {'type': 'string', 'example': f'value {field}', 'description': 'A field'}
+                for field in range(12)
+            }
+        }
+    paths = {}
+    for index in range(endpoint_count):
+        paths[f'/v1/resource{index}/{{id}}'] = {
+            'get': {
+                'operationId': f'GetResource{index}',
+                'summary': f'Get resource {index}',
+                'tags': [f'tag{index % 20}'],
+                'parameters': [{'name': 'id', 'in': 'path', 'schema': {'type': 'string'}}],
+                'responses': {
+                    '200': {
+                        'description': 'OK',
+                        'content': {'application/json': {'schema': {'$ref': f'#/components/schemas/Schema{index // 4}'}}}
+                    }
+                }
+            }
+        }
+    return {
+        'openapi': '3.0.0',
+        'servers': [{'url': 'https://api.example.com'}],
+        'paths': paths,
+        'components': {'schemas': schemas}
+    }
+
+
+def best_of(repeat, function):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--endpoints', type=int, default=3000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    spec_bytes = json.dumps(build_spec(args.endpoints)).encode('utf-8')
+    print(f'spec size: {len(spec_bytes) / 1e6:.1f} MB')
+    print(f'backend: {"orjson" if minifier.orjson else "msgspec" if minifier.msgspec else "stdlib json"}')
+
+    stdlib_load = best_of(args.repeat, lambda: json.load(io.BytesIO(spec_bytes)))
+    fast_load = best_of(args.repeat, lambda: minifier.json_loads(spec_bytes))
+    assert minifier.json_loads(spec_bytes) == json.loads(spec_bytes)
+    print(f'load spec:        json.load {stdlib_load:.3f}s  json_loads {fast_load:.3f}s  x{stdlib_load / fast_load:.1f}')
+
+    endpoints_by_tag_metadata, _ = minifier.minify(json.loads(spec_bytes))
+    documents = [minifier.endpoint_document(endpoint) for endpoints in endpoints_by_tag_metadata.values() for endpoint in endpoints]
+
+    def stdlib_dump():
+        outputs = []
+        for document in documents:
+            file = io.StringIO()
+            json.dump(document, file)
+            outputs.append(file.getvalue())
+        return outputs
+
+    def fast_dump():
+        outputs = []
+        for document in documents:
+            file = io.StringIO()
+            file.write(minifier.json_dumps(document))
+            outputs.append(file.getvalue())
+        return outputs
+
+    assert stdlib_dump() == fast_dump(), 'endpoint files would change'
+    stdlib_time = best_of(args.repeat, stdlib_dump)
+    fast_time = best_of(args.repeat, fast_dump)
+    print(f'dump {len(documents)} docs: json.dump {stdlib_time:.3f}s  json_dumps {fast_time:.3f}s  x{stdlib_time / fast_time:.1f}')
+
+    document_bytes = [output.encode('utf-8') for output in fast_dump()]
+    stdlib_time = best_of(args.repeat, lambda: [json.load(io.BytesIO(data)) for data in document_bytes])
+    fast_time = best_of(args.repeat, lambda: [minifier.json_loads(data) for data in document_bytes])
+    print(f'read {len(documents)} docs: json.load {stdlib_time:.3f}s  json_loads {fast_time:.3f}s  x{stdlib_time / fast_time:.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+"""Times each stage of the minifier on a synthetic spec and records throughput and the peak memory of each stage.
+
+Runs offline: the spec comes from synthetic_spec.py and tokens are counted with the approximate tokenizer unless
+--tokenizer says otherwise. Results are written as JSON together with the git commit and the parameters used,
+so runs on different commits can be compared.
+
+    python benchmarks/run_benchmarks.py --endpoints 3000 --output results.json
+    python benchmarks/run_benchmarks.py --endpoints 500 --cycles --max-depth 2
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import minifier
+from synthetic_spec import add_spec_arguments, generate_spec, spec_arguments
+
+
+def peak_rss_mb():
+    # High water mark of the whole process, ru_maxrss is in KB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak /= 1024
+    return round(peak / 1024, 1)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def time_stage(results, stage, item_count, repeat, function):
+    # Best of repeat runs, the value of the last run is returned for the next stage
+    timings = []
+    value = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = function()
+        timings.append(time.perf_counter() - start)
+    seconds = min(timings)
+    results[stage] = {
+        'seconds': round(seconds, 6),
+        'items': item_count,
+        'items_per_second': round(item_count / seconds, 1) if seconds else None,
+        'peak_memory_mb': stage_peak_memory_mb(function),
+    }
+    print(f'{stage:24} {seconds:9.4f}s  {results[stage]["items_per_second"] or 0:12.1f} items/s  '
+          f'peak memory {results[stage]["peak_memory_mb"]} MB')
+    return value
+
+
+def stage_peak_memory_mb(function):
+    # Most memory allocated at once during one more run of the stage. tracemalloc slows everything down,
+    # so this run isn't timed, and it only sees allocations made after it starts, unlike the process wide RSS
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return round(peak / 1024 / 1024, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_spec_arguments(parser)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--tokenizer', default='approximate', help="tokenizer_backend, 'approximate' needs no network")
+    parser.add_argument('--max-depth', type=int, default=-1, help='ref_expansion_max_depth, -1 for unlimited')
+    parser.add_argument('--max-nodes', type=int, default=-1, help='ref_expansion_max_nodes, -1 for unlimited')
+    parser.add_argument('--abbreviate', action='store_true')
+    parser.add_argument('--label', default='')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    minifier.tokenizer_backend = args.tokenizer
+    minifier.ref_expansion_max_depth = None if args.max_depth < 0 else args.max_depth
+    minifier.ref_expansion_max_nodes = None if args.max_nodes < 0 else args.max_nodes
+    minifier.key_abbreviations_enabled = args.abbreviate
+
+    results = {}
+    with tempfile.TemporaryDirectory() as working_directory:
+        input_directory = os.path.join(working_directory, 'input')
+        os.makedirs(input_directory)
+        spec_path = os.path.join(input_directory, 'synthetic.json')
+        with open(spec_path, 'w') as file:
+            json.dump(generate_spec(**spec_arguments(args)), file)
+        spec_megabytes = os.path.getsize(spec_path) / 1e6
+        print(f'spec: {spec_megabytes:.1f} MB')
+
+        minifier.input_filepath = input_directory
+        minifier.output_directory = os.path.join(working_directory, 'output')
+
+        openapi_spec = time_stage(results, 'load', 1, args.repeat, lambda: next(minifier.load()))
+        endpoint_jobs = [
+            (path, method)
+            for path, methods in openapi_spec['paths'].items()
+            for method, endpoint in methods.items()
+            if method in minifier.methods_to_handle
+        ]
+        endpoint_count = len(endpoint_jobs)
+
+        def resolve_all():
+            resolved_components = {}
+            component_cycles = {}
+            return [
+                minifier.resolve_refs(openapi_spec, openapi_spec['paths'][path][method], resolved_components, component_cycles)
+                for path, method in endpoint_jobs
+            ]
+        resolved_endpoints = time_stage(results, 'resolve_refs', endpoint_count, args.repeat, resolve_all)
+
+        def prune_all():
+            return [
+                minifier.remove_unnecessary_keys(minifier.remove_empty_keys(minifier.populate_keys(resolved_endpoint, path)))
+                for resolved_endpoint, (path, method) in zip(resolved_endpoints, endpoint_jobs)
+            ]
+        pruned_endpoints = time_stage(results, 'populate_and_prune', endpoint_count, args.repeat, prune_all)
+        time_stage(results, 'flatten_endpoint', endpoint_count, args.repeat,
+                   lambda: [minifier.flatten_endpoint(endpoint) for endpoint in pruned_endpoints])
+
+        transformed_endpoints = time_stage(results, 'transform_endpoint', endpoint_count, args.repeat, lambda: [
+            minifier.transform_endpoint(resolved_endpoint, path)
+            for resolved_endpoint, (path, method) in zip(resolved_endpoints, endpoint_jobs)
+        ])
+
+        def render_all():
+            # The sanitizer cache would make every repeat after the first a cache hit
+            minifier.remove_html_tags_and_punctuation.cache_clear()
+            return [minifier.write_dict_to_text(endpoint) for endpoint in transformed_endpoints]
+        contents = time_stage(results, 'write_dict_to_text', endpoint_count, args.repeat, render_all)
+
+        def count_all():
+            minifier.token_count_cache.clear()
+            return minifier.tiktoken_len_batch(contents)
+        token_counts = time_stage(results, 'tokenization', endpoint_count, args.repeat, count_all)
+
+        endpoints_by_tag_metadata, tag_summary_dict = time_stage(
+            results, 'minify', endpoint_count, 1, lambda: minifier.minify(openapi_spec)
+        )
+
+        def write_all():
+            minifier.operationID_counter = 0
+            return minifier.create_endpoint_files(endpoints_by_tag_metadata, openapi_spec)
+        time_stage(results, 'create_endpoint_files', endpoint_count, args.repeat, write_all)
+        minifier.close_archives()
+
+    report = {
+        'label': args.label,
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': dict(
+            spec_arguments(args),
+            tokenizer=args.tokenizer,
+            max_depth=args.max_depth,
+            max_nodes=args.max_nodes,
+            abbreviate=args.abbreviate,
+            repeat=args.repeat,
+        ),
+        'spec_megabytes': round(spec_megabytes, 2),
+        'endpoints': endpoint_count,
+        'total_tokens': sum(token_counts),
+        'stages': results,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f'results written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""Microbenchmark of remove_html_tags_and_punctuation against the version that used to be nested in write_dict_to_text.
+
+Runs both over every key and scalar write_dict_to_text sanitizes for a generated spec, checks the results are
+identical and prints the timings.
+
+    python benchmarks/sanitizer.py --endpoints 1000
+"""
+import argparse
+import os
+import re
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import minifier
+from json_backend import build_spec
+
+
+def reference_remove_html_tags_and_punctuation(input_str):
+    # Strip HTML tags
+    no_html_str = re.sub('<.*?>', '', input_str)
+    # Define the characters that should be considered as punctuation
+    modified_punctuation = set(string.punctuation) - {'/', '#'}
+    # Remove punctuation characters
+    return ''.join(ch for ch in no_html_str if ch not in modified_punctuation).strip()
+
+
+def sanitized_strings(data, strings):
+    # Same strings write_dict_to_text passes to the sanitizer
+    if isinstance(data, dict):
+        for key, value in data.items():
+            strings.append(key)
+            if isinstance(value, (dict, list)):
+                sanitized_strings(value, strings)
+            else:
+                strings.append(str(value))
+    elif isinstance(data, list):
+        for item in data:
+            sanitized_strings(item, strings)
+    else:
+        strings.append(str(data))
+    return strings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--endpoints', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    openapi_spec = build_spec(args.endpoints)
+    strings = []
+    resolved_components = {}
+    for path, methods in openapi_spec['paths'].items():
+        for method, endpoint in methods.items():
+            resolved_endpoint = minifier.resolve_refs(openapi_spec, endpoint, resolved_components)
+            sanitized_strings(minifier.transform_endpoint(resolved_endpoint, path), strings)
+    strings.extend(['<p>Some <b>html</b>, with: punctuation!</p>', 'path /v1/{id}#frag', '  spaced; out.  '])
+    print(f'{len(strings)} strings, {len(set(strings))} distinct')
+
+    assert [minifier.remove_html_tags_and_punctuation(text) for text in strings] == \
+        [reference_remove_html_tags_and_punctuation(text) for text in strings], 'sanitized output changed'
+
+    timings = {}
+    for name, function in (
+        ('reference', reference_remove_html_tags_and_punctuation),
+        ('uncached', minifier.remove_html_tags_and_punctuation.__wrapped__),
+        ('cached', minifier.remove_html_tags_and_punctuation),
+    ):
+        best = None
+        for _ in range(args.repeat):
+            # Every repeat starts with an empty cache, so the cached timing only counts repeats within one pass
+            minifier.remove_html_tags_and_punctuation.cache_clear()
+            start = time.perf_counter()
+            for text in strings:
+                function(text)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        timings[name] = best
+        print(f'{name:10} {best:.4f}s  x{timings["reference"] / best:.1f}')
+
+
+if __name__ == '__main__':
+    main()
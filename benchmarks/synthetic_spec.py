@@ -0,0 +1,156 @@
+"""Generates synthetic OpenAPI specs for benchmarking the minifier.
+
+Every shape the minifier cares about is tunable: endpoint count, inline schema depth, properties per object,
+how often schemas are shared through $refs and whether the refs form cycles. The same arguments and seed always
+produce the same spec.
+
+    python benchmarks/synthetic_spec.py --endpoints 3000 --cycles output.json
+"""
+import argparse
+import json
+import random
+
+
+def generate_spec(endpoints=1000, depth=2, fan_out=6, ref_reuse=0.1, ref_depth=2, cycles=False, tags=20, seed=0):
+    # endpoints  number of operations
+    # depth      levels of inline objects nested inside a component
+    # fan_out    properties per object
+    # ref_reuse  chance a property or response points at a component instead of an inline schema
+    # ref_depth  components are split into ref_depth + 1 levels, each level only refers to the next one,
+    #            this bounds how far a fully expanded endpoint grows
+    # cycles     let components reference any component including themselves, so resolving loops back
+    rng = random.Random(seed)
+    component_count = max(1, endpoints // 4)
+    component_names = [f'Component{index}' for index in range(component_count)]
+    level_count = min(ref_depth + 1, component_count)
+    level_bounds = [component_count * level // level_count for level in range(level_count + 1)]
+
+    def component_level(index):
+        return next(level for level in range(level_count) if index < level_bounds[level + 1])
+
+    def ref_to(index):
+        return {'$ref': f'#/components/schemas/{component_names[index]}'}
+
+    def scalar_schema(name):
+        schema_type = rng.choice(['string', 'integer', 'number', 'boolean'])
+        schema = {
+            'type': schema_type,
+            'description': f'The <code>{name}</code> of the resource, see the <a href="#">docs</a>.',
+        }
+        if schema_type == 'string' and rng.random() < 0.3:
+            schema['enum'] = [f'VALUE_{value}' for value in range(rng.randint(2, 8))]
+        if rng.random() < 0.5:
+            schema['example'] = f'example-{name}'
+        if rng.random() < 0.2:
+            schema['description'] = ''
+        return schema
+
+    def object_schema(component_index, remaining_depth):
+        properties = {}
+        for property_index in range(fan_out):
+            name = f'field{property_index}'
+            roll = rng.random()
+            if roll < ref_reuse:
+                level = component_level(component_index) + 1 if component_index < component_count else 0
+                if cycles:
+                    properties[name] = ref_to(rng.randrange(component_count))
+                elif level < level_count:
+                    properties[name] = ref_to(rng.randrange(level_bounds[level], level_bounds[level + 1]))
+                else:
+                    properties[name] = scalar_schema(name)
+            elif remaining_depth > 0 and roll < ref_reuse + (1 - ref_reuse) / 6:
+                properties[name] = object_schema(component_index, remaining_depth - 1)
+            elif remaining_depth > 0 and roll < ref_reuse + (1 - ref_reuse) / 4:
+                properties[name] = {'type': 'array', 'items': object_schema(component_index, remaining_depth - 1)}
+            else:
+                properties[name] = scalar_schema(name)
+        return {
+            'type': 'object',
+            'description': 'An object with <b>several</b> fields.',
+            'properties': properties,
+        }
+
+    schemas = {name: object_schema(index, depth) for index, name in enumerate(component_names)}
+
+    def response_schema():
+        if rng.random() < ref_reuse:
+            return ref_to(rng.randrange(component_count))
+        return object_schema(component_count, depth)
+
+    tag_names = [f'tag{index}' for index in range(tags)]
+    paths = {}
+    operation_index = 0
+    while operation_index < endpoints:
+        path = f'/v1/{rng.choice(tag_names)}/resource{operation_index}/{{id}}'
+        methods = {}
+        for method in rng.sample(['get', 'post', 'patch', 'delete'], rng.randint(1, 4)):
+            if operation_index >= endpoints:
+                break
+            operation = {
+                'operationId': f'{method.title()}Resource{operation_index}',
+                'summary': f'{method.title()} resource {operation_index}',
+                'description': f'Does {method} on resource {operation_index}. <p>Returns the <b>resource</b>.</p>',
+                'tags': [rng.choice(tag_names)],
+                'parameters': [
+                    {'name': 'id', 'in': 'path', 'required': True, 'description': 'Resource id', 'schema': {'type': 'string'}},
+                    {'name': 'limit', 'in': 'query', 'schema': {'type': 'integer', 'example': 10}},
+                ],
+                'responses': {
+                    '200': {'description': 'OK', 'content': {'application/json': {'schema': response_schema()}}},
+                    '401': {'description': 'Unauthorized', 'content': {'application/json': {'schema': ref_to(0)}}},
+                    'default': {'description': 'Error', 'content': {'application/json': {'schema': ref_to(0)}}},
+                },
+            }
+            if method in ('post', 'patch'):
+                operation['requestBody'] = {'content': {'application/json': {'schema': response_schema()}}}
+            if rng.random() < 0.05:
+                operation['deprecated'] = True
+            methods[method] = operation
+            operation_index += 1
+        paths[path] = methods
+
+    return {
+        'openapi': '3.0.0',
+        'info': {'title': 'Synthetic benchmark API', 'version': '1.0.0'},
+        'servers': [{'url': 'https://synthetic.example.com/api'}],
+        'tags': [{'name': name, 'description': f'Operations on {name} resources.'} for name in tag_names],
+        'paths': paths,
+        'components': {'schemas': schemas},
+    }
+
+
+def add_spec_arguments(parser):
+    parser.add_argument('--endpoints', type=int, default=1000)
+    parser.add_argument('--depth', type=int, default=2)
+    parser.add_argument('--fan-out', type=int, default=6)
+    parser.add_argument('--ref-reuse', type=float, default=0.1)
+    parser.add_argument('--ref-depth', type=int, default=2)
+    parser.add_argument('--cycles', action='store_true')
+    parser.add_argument('--tags', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def spec_arguments(args):
+    return {
+        'endpoints': args.endpoints,
+        'depth': args.depth,
+        'fan_out': args.fan_out,
+        'ref_reuse': args.ref_reuse,
+        'ref_depth': args.ref_depth,
+        'cycles': args.cycles,
+        'tags': args.tags,
+        'seed': args.seed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_spec_arguments(parser)
+    parser.add_argument('output', help='JSON file to write')
+    args = parser.parse_args()
+    with open(args.output, 'w') as file:
+        json.dump(generate_spec(**spec_arguments(args)), file)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""Checks that transform_endpoint gives exactly the output of the step by step chain it replaces, and times both.
+
+The chain is populate_keys -> remove_empty_keys -> remove_unnecessary_keys -> flatten_endpoint -> abbreviate, as
+minify_endpoint runs it when fused_transforms_enabled is off. Every endpoint of a generated spec, plus a few odd
+shapes, goes through both with every combination of the keys_to_keep flags they read and with abbreviations on and off.
+
+    python benchmarks/transform_endpoint.py --endpoints 10
+"""
+import argparse
+import copy
+import itertools
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import minifier
+from synthetic_spec import generate_spec
+
+# keys_to_keep flags read by the transform steps
+transform_flags = [
+    'parameters', 'endpoint_summaries', 'endpoint_descriptions', 'request_bodies', 'good_responses',
+    'bad_responses', 'examples', 'enums', 'nested_descriptions',
+]
+
+
+def odd_endpoints():
+    # Shapes the generated spec doesn't have: empty and None values, lists in lists, single key dicts to flatten,
+    # keys that only match an abbreviation or an excluded key once lowercased
+    return [
+        ('/odd/{id}', {
+            'operationId': 'OddOne',
+            'summary': '',
+            'description': None,
+            'parameters': [{'a': {'b': {'c': None, 'example': 1}}}, [{'x': ''}, []], {}],
+            'requestBody': {'content': {'application/json': {'schema': {'type': 'Object', 'Description': 'Kept'}}}},
+            'responses': {
+                '200': {'description': '', 'content': {'a': {'schema': {'properties': {'Type': 'String', 'type': 'object'}}}}},
+                '404': {'description': 'Missing', 'content': {'a': {'schema': {'enum': ['A', 'B'], 'example': 'A'}}}},
+                '500': {},
+            },
+        }),
+        ('/odd/nested', {
+            'operationId': 'OddTwo',
+            'parameters': [{'schema': {'items': {'items': {'items': {'type': 'array'}}}}}],
+            'responses': {'201': {'description': 'Made', 'content': {'text/plain': {'schema': {'type': 'string', 'enum': []}}}}},
+        }),
+    ]
+
+
+def chained_transform(endpoint, path):
+    extracted_endpoint_data = minifier.populate_keys(endpoint, path)
+    extracted_endpoint_data = minifier.remove_empty_keys(extracted_endpoint_data)
+    extracted_endpoint_data = minifier.remove_unnecessary_keys(extracted_endpoint_data)
+    extracted_endpoint_data = minifier.flatten_endpoint(extracted_endpoint_data)
+    if minifier.key_abbreviations_enabled:
+        extracted_endpoint_data = minifier.abbreviate(extracted_endpoint_data, minifier.key_abbreviations)
+    return extracted_endpoint_data
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--endpoints', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    openapi_spec = generate_spec(endpoints=args.endpoints, depth=2, fan_out=4, ref_reuse=0.3)
+    endpoints = [
+        (path, endpoint)
+        for path, methods in openapi_spec['paths'].items()
+        for method, endpoint in methods.items()
+    ] + odd_endpoints()
+    resolved_components = {}
+    inputs = [(path, endpoint) for path, endpoint in endpoints] + [
+        (path, minifier.resolve_refs(openapi_spec, endpoint, resolved_components)) for path, endpoint in endpoints
+    ]
+
+    # Neither may change its input, the cached components are shared between endpoints
+    original_inputs = copy.deepcopy(inputs)
+    combinations = 0
+    original_keys_to_keep = dict(minifier.keys_to_keep)
+    for flags in itertools.product([True, False], repeat=len(transform_flags)):
+        minifier.keys_to_keep = dict(original_keys_to_keep, **dict(zip(transform_flags, flags)))
+        for abbreviate in (False, True):
+            minifier.key_abbreviations_enabled = abbreviate
+            for path, endpoint in inputs:
+                fused = minifier.transform_endpoint(endpoint, path)
+                chained = chained_transform(endpoint, path)
+                settings = dict(zip(transform_flags, flags), abbreviate=abbreviate)
+                assert fused == chained, f'transform_endpoint differs for {path} with {settings}'
+                assert minifier.write_dict_to_text(fused) == minifier.write_dict_to_text(chained), f'text differs for {path}'
+            combinations += 1
+    minifier.keys_to_keep = original_keys_to_keep
+    minifier.key_abbreviations_enabled = False
+    assert inputs == original_inputs, 'an endpoint was changed in place'
+    print(f'{combinations} setting combinations x {len(inputs)} endpoints identical')
+
+    timings = {}
+    for name, function in (('chained', chained_transform), ('fused', minifier.transform_endpoint)):
+        best = None
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            for path, endpoint in inputs:
+                function(endpoint, path)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        timings[name] = best
+        print(f'{name:8} {best:.4f}s  x{timings["chained"] / best:.1f}')
+
+
+if __name__ == '__main__':
+    main()
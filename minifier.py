@@ -1,13 +1,61 @@
 import json
 import os
-import tiktoken
-from collections import defaultdict
+import hashlib
+import math
+import heapq
+import bisect
+import csv
+from collections import defaultdict, Counter
+from functools import lru_cache
 import string
 import re
 import shutil
+import struct
+import mmap
+import tempfile
+import yaml
+import argparse
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from urllib.parse import urlparse
 
-tokenizer = tiktoken.encoding_for_model("text-embedding-ada-002")
+# Optional faster JSON parsers, the stdlib json module is used when neither is installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+# Optional columnar formats for the export, see export_format
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Backend used for token counts, loaded on first use so imports and offline runs don't need the network
+#   'tiktoken'     tiktoken's encoding for tokenizer_model, downloaded by tiktoken the first time
+#   'bpe_file'     a local cl100k_base .tiktoken file at tokenizer_bpe_file, same counts as 'tiktoken' without the download
+#   'approximate'  len(text) / approximate_chars_per_token, no tokenizer needed at all
+#   a callable     any function taking a string and returning its token count
+tokenizer_backend = 'tiktoken'
+tokenizer_model = "text-embedding-ada-002"
+tokenizer_bpe_file = None
+approximate_chars_per_token = 4
+# The loaded backend, see get_tokenizer
+tokenizer = None
+# Threads used by tiktoken when counting tokens in batches
+token_count_threads = 8
+# Token counts keyed by a hash of the counted text, so each distinct text is only tokenized once per run
+# Cleared by reset_run_state at the start and end of every Minifier run
+token_count_cache = {}
 
 output_directory = 'minified_openAPI_specs'
 
@@ -61,13 +109,385 @@ key_abbreviations = {
 
 key_abbreviations_enabled = False
 
+# Caps how much of the referenced schemas get inlined into each endpoint, None means no limit
+# max_depth counts nested $refs, max_nodes counts the dicts, lists and values copied for one endpoint
+# Past either limit the schema is replaced with a {'schemaName': name} stub
+ref_expansion_max_depth = None
+ref_expansion_max_nodes = None
+
+# Runs the key filtering, pruning, flattening and abbreviation steps as one walk over each endpoint
+# The output is identical to running the steps one after the other
+fused_transforms_enabled = True
+
+# Spread endpoint processing over this many worker processes, None or 1 processes everything in this process
+parallel_workers = None
+# Number of endpoints handed to a worker at a time
+parallel_chunk_size = 16
+
+# Settings copied into the worker processes
+worker_settings = [
+    "keys_to_keep",
+    "key_abbreviations",
+    "key_abbreviations_enabled",
+    "ref_expansion_max_depth",
+    "ref_expansion_max_nodes",
+    "fused_transforms_enabled",
+    "stage_report_enabled",
+    # Workers count tokens for the stage report
+    "tokenizer_backend",
+    "tokenizer_model",
+    "tokenizer_bpe_file",
+    "approximate_chars_per_token",
+]
+worker_openapi_spec = None
+worker_resolved_components = None
+worker_component_cycles = None
+
+# How the endpoint documents are written
+#   'files'    one {tag}-{doc_number}.json file per endpoint in operationIDs/
+#   'jsonl'    every document as one line of operationIDs.jsonl
+#   'archive'  operationIDs.jsonl plus operationIDs.index.json with the byte offset and length of each doc_number
+output_format = 'files'
+archive_file_name = 'operationIDs.jsonl'
+archive_index_file_name = 'operationIDs.index.json'
+# Open archives and loaded archive indexes by output directory
+archive_writers = {}
+archive_indexes = {}
+
+# Used by remove_html_tags_and_punctuation when writing the endpoint text
+html_tag_pattern = re.compile('<.*?>')
+# Deletes the characters that should be considered as punctuation, everything in string.punctuation except / and #
+punctuation_table = str.maketrans('', '', ''.join(sorted(set(string.punctuation) - {'/', '#'})))
+# Number of distinct strings remove_html_tags_and_punctuation remembers
+# Unlike the other settings this is read once, when the module is imported, and isn't one of minifier_settings.
+# Changing it afterwards has no effect, remove_html_tags_and_punctuation.cache_clear() empties the cache
+sanitizer_cache_size = 65536
+
+# Write components that many endpoints use once, as their own documents, instead of inlining them everywhere
+# Endpoints keep a {'schemaName': name, 'schemaId': id} stub and the keypoint guide lists the schemaIds as documents
+shared_schemas_enabled = False
+# Minimum number of endpoints using a component and minimum tokens of its text for it to be shared
+shared_schema_min_reuse = 5
+shared_schema_min_tokens = 100
+shared_schema_tag = 'shared_schemas'
+shared_schema_tag_description = 'schemas used by many endpoints, endpoints refer to them by schemaId'
+# schemaIds given out per output directory in this run, see shared_schema_id
+shared_schema_ids = defaultdict(set)
+
+# Record the tokens and bytes of every endpoint after each step of minify() and write a report per output directory
+# with totals per stage and per tag. A .csv file name writes CSV, anything else JSON.
+# Endpoints reused by an incremental run aren't minified, so they aren't in the report
+stage_report_enabled = False
+stage_report_file_name = 'stage_report.json'
+stage_names = ['raw', 'refs_resolved', 'populated', 'pruned', 'flattened', 'abbreviated', 'rendered']
+# Measured endpoints by output directory
+stage_report_endpoints = defaultdict(list)
+
+# Only re-minify and rewrite endpoints whose source changed since the last run
+# Each output directory keeps a manifest with a hash per operation covering the endpoint and the components it references
+incremental_enabled = False
+manifest_file_name = 'minifier_manifest.json'
+# Settings that change the content or metadata of a document, part of every operation hash. Settings that only
+# change how the output is produced or measured, like the tokenizer or the stage report, would force a full rebuild
+# for nothing. Shared schemas are hashed per operation, see get_operation_hashes
+output_settings = [
+    "keys_to_keep",
+    "key_abbreviations",
+    "key_abbreviations_enabled",
+    "ref_expansion_max_depth",
+    "ref_expansion_max_nodes",
+    "api_url_format",
+]
+# Manifests of the previous and the current run by output directory
+previous_manifests = {}
+current_manifests = {}
+
 operationID_counter = 0
 
+# How documents are numbered
+#   'sequential'  0, 1, 2... in output order, adding an endpoint renumbers every document after it
+#   'stable'      a hash of the server url, method, path and operation id, cut to stable_doc_number_digits digits.
+#                 Numbers given out are kept in doc_number_map_file_name in each output directory, so a collision
+#                 is settled once and an endpoint keeps its number for as long as the map is kept
+doc_numbering = 'sequential'
+stable_doc_number_digits = 6
+doc_number_map_file_name = 'doc_numbers.json'
+# Loaded maps of document key to doc_number by output directory
+doc_number_maps = {}
+
+# Also write "balanced chunks", documents that combine endpoints of the same tag into roughly token_count_goal tokens
+balanced_chunks_enabled = False
+token_count_goal = 3000
+# Hard cap for a chunk, an endpoint over this on its own is replaced with a pointer to its docs
+token_count_max = 4500
+balanced_chunks_directory_name = 'balanced_chunks'
+chunk_counter = 0
+# Output directories whose balanced_chunks folder was already cleared this run
+chunk_directories_started = set()
+
+# Write the endpoint files from this many threads, so slow or network mounted disks don't hold up the next spec
+# None or 0 writes each file before moving on to the next
+file_writer_threads = None
+# Most files queued at once, create_endpoint_files waits for a write to finish when the queue is full
+file_writer_max_pending = 256
+file_writer = None
+file_writer_slots = None
+# Queued writes in the order they were queued, as (file_path, future)
+pending_file_writes = []
+
+# Write each output directory into a new version under output_directory/.versions and swap it in when the run is done,
+# so readers see either the previous or the new output, never a partly written one.
+# output_directory/{netloc} becomes a symlink to its current version, which needs a POSIX file system
+staged_output_enabled = False
+staged_versions_directory_name = '.versions'
+# Previous versions kept next to the current one, for readers still going through them
+staged_versions_kept = 1
+# Version directories being written this run by the output directory they replace
+staged_directories = {}
+
+# Also write a binary index next to the keypoint guide, mapping operation id, doc_number, tag and path to where each
+# document is stored. It's read through mmap by lookup_guide_index without loading or parsing the whole file
+guide_index_enabled = False
+guide_index_file_name = 'LLM_OAS_keypoint_guide_index.bin'
+guide_index_keys = ['operation_id', 'doc_number', 'tag', 'path']
+# magic, record count, hash table slots per key, posting count, string bytes
+guide_index_header = struct.Struct('<8sIIII')
+# key hash, key string offset, first posting, posting count
+guide_index_slot = struct.Struct('<QIII')
+# doc_number, byte offset, byte length (0 for the whole file), then string offsets of file, tag, operation id, path, method
+guide_index_record = struct.Struct('<IQIIIIII')
+guide_index_magic = b'OASGIDX1'
+# Open indexes by output directory
+guide_indexes = {}
+
+# How the keypoint guide lists the operations
+#   'flat'    every operation of every tag in LLM_OAS_keypoint_guide_file.txt
+#   'tiered'  only the tags and their descriptions, within guide_token_budget tokens. The operations of a tag are
+#             listed by tag_guide_text when asked for, from the guide index, which is always written in this mode
+guide_mode = 'flat'
+guide_token_budget = 2000
+# Tiered guides with more tags than fit the budget even without descriptions are split into these group files.
+# Groups of tags come first, then groups listing groups if the list of groups doesn't fit the budget either
+guide_group_file_name = 'LLM_OAS_keypoint_guide_group_{group}.txt'
+
+# Also write a BM25 index of the endpoint contents, search_endpoints uses it to find doc_numbers without an LLM call
+search_index_enabled = False
+search_index_file_name = 'search_index.json'
+search_bm25_k1 = 1.2
+search_bm25_b = 0.75
+search_term_pattern = re.compile('[a-z0-9]+')
+# Term counts of every written endpoint by output directory, as (doc_number, Counter)
+search_index_documents = defaultdict(list)
+# Loaded indexes by output directory
+search_indexes = {}
+
+# Also export every document in columnar batches for embedding jobs, with a stable id, its text, token count and metadata
+#   'parquet'  batch-00000.parquet files, needs pyarrow
+#   'npz'      batch-00000.npz files of numpy arrays, needs numpy. A text column is stored as {column}_bytes, the UTF-8
+#              of its values one after another, and {column}_offsets, where value i is bytes[offsets[i]:offsets[i + 1]]
+#   'json'     batch-00000.json files, each an object of column name to list of values
+#   'auto'     the first of those that is installed
+# id is a hash of the method, server url and path, so it stays the same when doc_numbers shift.
+# content_hash changes whenever the text does, so loaders can skip unchanged documents
+export_enabled = False
+export_format = 'auto'
+export_directory_name = 'export'
+export_batch_size = 10000
+export_columns = [
+    'id', 'content_hash', 'doc_number', 'tag', 'operation_id', 'method', 'path', 'server_url', 'doc_url', 'token_count', 'text'
+]
+# Rows not written yet and batches written so far by output directory
+export_rows = defaultdict(list)
+export_batch_counts = {}
+
+# Settings a Minifier can override, everything it doesn't set keeps the value above
+minifier_settings = [
+    "input_filepath",
+    "output_directory",
+    "api_url_format",
+    "keys_to_keep",
+    "methods_to_handle",
+    "key_abbreviations",
+    "key_abbreviations_enabled",
+    "ref_expansion_max_depth",
+    "ref_expansion_max_nodes",
+    "fused_transforms_enabled",
+    "parallel_workers",
+    "parallel_chunk_size",
+    "output_format",
+    "shared_schemas_enabled",
+    "shared_schema_min_reuse",
+    "shared_schema_min_tokens",
+    "stage_report_enabled",
+    "stage_report_file_name",
+    "incremental_enabled",
+    "balanced_chunks_enabled",
+    "token_count_goal",
+    "token_count_max",
+    "file_writer_threads",
+    "file_writer_max_pending",
+    "staged_output_enabled",
+    "staged_versions_kept",
+    "guide_index_enabled",
+    "guide_mode",
+    "guide_token_budget",
+    "search_index_enabled",
+    "export_enabled",
+    "export_format",
+    "export_batch_size",
+    "doc_numbering",
+    "stable_doc_number_digits",
+    "tokenizer_backend",
+    "tokenizer_model",
+    "tokenizer_bpe_file",
+    "approximate_chars_per_token",
+    "token_count_threads",
+]
+# Settings the loaded tokenizer depends on, and their values when it was loaded
+tokenizer_settings = ["tokenizer_backend", "tokenizer_model", "tokenizer_bpe_file", "approximate_chars_per_token"]
+loaded_tokenizer_settings = None
+# Runs read the module settings, so only one Minifier runs at a time
+minifier_lock = threading.RLock()
+
+class Minifier:
+    """Minifies OpenAPI specs with its own settings, so one long lived process can handle many specs.
+
+    Settings are any of minifier_settings as keyword arguments. The tokenizer and the sanitizer cache stay
+    loaded between runs and are shared by every Minifier using the same tokenizer, token counts are only
+    cached for the length of a run.
+    """
+
+    def __init__(self, **settings):
+        unknown_settings = sorted(set(settings) - set(minifier_settings))
+        if unknown_settings:
+            raise ValueError(f"Unknown settings: {', '.join(unknown_settings)}")
+        self.settings = settings
+
+    @contextmanager
+    def configured(self):
+        # Applies the settings to the module for the length of a run and puts the previous values back afterwards
+        # Doc and chunk numbers start from 0 for every run
+        global operationID_counter, chunk_counter
+        with minifier_lock:
+            module_globals = globals()
+            previous_settings = {name: module_globals[name] for name in minifier_settings}
+            previous_counters = operationID_counter, chunk_counter
+            module_globals.update(self.settings)
+            operationID_counter = 0
+            chunk_counter = 0
+            reset_run_state()
+            try:
+                yield self
+            finally:
+                module_globals.update(previous_settings)
+                operationID_counter, chunk_counter = previous_counters
+                reset_run_state()
+
+    def minify(self, openapi_spec):
+        """Minify one parsed spec in memory, returns the endpoints by tag and the tag descriptions."""
+        with self.configured():
+            return minify(openapi_spec)
+
+    def documents(self, openapi_spec):
+        """Minify one parsed spec in memory, returns its documents numbered as they'd be written and its keypoint guide."""
+        with self.configured():
+            endpoints_by_tag_metadata, tag_summary_dict = minify(openapi_spec)
+            documents = []
+            for tag, endpoints_with_tag in endpoints_by_tag_metadata.items():
+                for endpoint in endpoints_with_tag:
+                    if doc_numbering == 'stable':
+                        # Same numbers as the written output, new endpoints aren't added to its map
+                        endpoint['metadata']['doc_number'] = stable_doc_number(get_output_directory_path(openapi_spec), endpoint)
+                    else:
+                        endpoint['metadata']['doc_number'] = len(documents)
+                    documents.append(endpoint_document(endpoint))
+            sorted_tag_summary_dict = defaultdict(str, sorted(tag_summary_dict.items()))
+            return documents, key_point_guide_text(endpoints_by_tag_metadata, sorted_tag_summary_dict)
+
+    def run(self, openapi_specs=None):
+        """Minify and write the given parsed specs, or every spec in input_filepath, like running the script."""
+        with self.configured():
+            minify_specs(load() if openapi_specs is None else openapi_specs)
+
+def reset_run_state():
+    # Forgets everything a run collects for its output directories. After a run that failed halfway this drops its
+    # queued writes and unfinished archives, so the next run doesn't write them into its own output
+    global file_writer
+    if file_writer is not None:
+        file_writer.shutdown(wait=True, cancel_futures=True)
+        file_writer = None
+    pending_file_writes.clear()
+    for root_output_directory, archive in archive_writers.items():
+        archive['file'].close()
+        unfinished_archive_path = os.path.join(root_output_directory, f'{archive_file_name}.tmp')
+        if os.path.exists(unfinished_archive_path):
+            os.remove(unfinished_archive_path)
+    archive_writers.clear()
+    archive_indexes.clear()
+    chunk_directories_started.clear()
+    shared_schema_ids.clear()
+    staged_directories.clear()
+    doc_number_maps.clear()
+    previous_manifests.clear()
+    current_manifests.clear()
+    stage_report_endpoints.clear()
+    search_index_documents.clear()
+    export_rows.clear()
+    export_batch_counts.clear()
+    # A long running process would otherwise keep the counts of every spec version it has seen
+    token_count_cache.clear()
+
+def main(argv=None):
+    Minifier(**parse_arguments(argv)).run()
+
+def parse_arguments(argv=None):
+    # Command line flags override the settings at the top of this file, --settings reads any of minifier_settings from JSON
+    parser = argparse.ArgumentParser(description='Minify OpenAPI specs into documents for LLM context.')
+    parser.add_argument('input_filepath', nargs='?', help='directory with the .json or .yaml specs')
+    parser.add_argument('-o', '--output-directory', dest='output_directory')
+    parser.add_argument('--api-url-format', dest='api_url_format')
+    parser.add_argument('--output-format', dest='output_format', choices=['files', 'jsonl', 'archive'])
+    parser.add_argument('--tokenizer', dest='tokenizer_backend', choices=['tiktoken', 'bpe_file', 'approximate'])
+    parser.add_argument('--tokenizer-bpe-file', dest='tokenizer_bpe_file')
+    parser.add_argument('--workers', dest='parallel_workers', type=int)
+    parser.add_argument('--writer-threads', dest='file_writer_threads', type=int)
+    parser.add_argument('--max-ref-depth', dest='ref_expansion_max_depth', type=int)
+    parser.add_argument('--max-ref-nodes', dest='ref_expansion_max_nodes', type=int)
+    parser.add_argument('--abbreviate', dest='key_abbreviations_enabled', action='store_true', default=None)
+    parser.add_argument('--incremental', dest='incremental_enabled', action='store_true', default=None)
+    parser.add_argument('--balanced-chunks', dest='balanced_chunks_enabled', action='store_true', default=None)
+    parser.add_argument('--shared-schemas', dest='shared_schemas_enabled', action='store_true', default=None)
+    parser.add_argument('--guide-mode', dest='guide_mode', choices=['flat', 'tiered'])
+    parser.add_argument('--guide-token-budget', dest='guide_token_budget', type=int)
+    parser.add_argument('--doc-numbering', dest='doc_numbering', choices=['sequential', 'stable'])
+    parser.add_argument('--export', dest='export_format', choices=['auto', 'parquet', 'npz', 'json'],
+                        help='also export the documents in columnar batches in this format')
+    parser.add_argument('--search-index', dest='search_index_enabled', action='store_true', default=None)
+    parser.add_argument('--guide-index', dest='guide_index_enabled', action='store_true', default=None)
+    parser.add_argument('--staged-output', dest='staged_output_enabled', action='store_true', default=None)
+    parser.add_argument('--stage-report', dest='stage_report_enabled', action='store_true', default=None)
+    parser.add_argument('--settings', help='JSON file of settings, flags take precedence')
+    arguments = vars(parser.parse_args(argv))
+
+    settings = {}
+    settings_file = arguments.pop('settings')
+    if settings_file:
+        with open(settings_file, 'rb') as file:
+            settings.update(json_loads(file.read()))
+        # JSON has no sets
+        if 'methods_to_handle' in settings:
+            settings['methods_to_handle'] = set(settings['methods_to_handle'])
+    settings.update((name, value) for name, value in arguments.items() if value is not None)
+    if arguments['export_format'] is not None:
+        settings['export_enabled'] = True
+    return settings
+
 def load():
-        """Load YAML or JSON files."""
-        documents = []
+        """Lazily load YAML or JSON files, yielding one document at a time."""
+        filenames = sorted(os.listdir(input_filepath))
+        # Check every file up front so a bad directory fails before any output is written
         file_extension = None
-        for filename in os.listdir(input_filepath):
+        for filename in filenames:
             if file_extension is None:
                 if filename.endswith('.yaml'):
                     file_extension = '.yaml'
@@ -78,45 +498,103 @@ def load():
             elif not filename.endswith(file_extension):
                 raise ValueError(f"Inconsistent file formats in directory: {filename}")
 
-            file_path = os.path.join(input_filepath, filename)
-            with open(file_path, 'r') as file:
-                if file_extension == '.yaml':
-                    documents.append(yaml.safe_load(file))
-                elif file_extension == '.json':
-                    documents.append(json.load(file))
-        return documents
-
-def main():
-    
-    # # Load JSON file into a Python dictionary
-    # with open(input_filepath) as f:
-    #     openapi_spec = json.load(f)
-
-    openapi_specs = load()
-    
-    endpoints_by_tag_metadata_dict = defaultdict(list)
-    tag_summary_dict = defaultdict(list)
-    
-    for openapi_spec in openapi_specs:
-        # Create list of processed and parsed individual endpoints
-        endpoints_by_tag_metadata, tag_summary_dict_output = minify(openapi_spec)
-        
-        # Append the outputs to the lists
-        for key, val in endpoints_by_tag_metadata.items():
-            endpoints_by_tag_metadata_dict[key].extend(val)    
-        for key, val in tag_summary_dict_output.items():
-            tag_summary_dict[key].extend(val)    
-
-    # Sort the data
-    sorted_items = sorted(endpoints_by_tag_metadata_dict.items())  
-    sorted_endpoints_by_tag_metadata_dict = defaultdict(list, sorted_items)
-    sorted_items = sorted(tag_summary_dict.items())  
-    sorted_tag_summary_dict = defaultdict(list, sorted_items)
-      
-    sorted_endpoints_by_tag_metadata_dict, root_output_directory = create_endpoint_files(sorted_endpoints_by_tag_metadata_dict, openapi_spec)
-    create_key_point_guide(sorted_endpoints_by_tag_metadata_dict, sorted_tag_summary_dict, root_output_directory)
+        for filename in filenames:
+            yield load_file(os.path.join(input_filepath, filename))
+
+def load_file(file_path):
+    if file_path.endswith('.yaml'):
+        with open(file_path, 'r') as file:
+            return yaml.safe_load(file)
+    elif file_path.endswith('.json'):
+        with open(file_path, 'rb') as file:
+            return json_loads(file.read())
+    raise ValueError(f"Unsupported file format: {file_path}")
+
+def json_loads(data):
+    # Parses with orjson or msgspec when installed, they return the same objects as json.loads
+    # Anything they reject but the stdlib accepts (NaN, huge ints) falls back to json.loads
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except ValueError:
+            pass
+    elif msgspec is not None:
+        try:
+            return msgspec.json.decode(data)
+        except msgspec.DecodeError:
+            pass
+    return json.loads(data)
+
+def json_dumps(data):
+    # Output has to stay byte for byte what json.dump wrote, which orjson and msgspec can't do (no ", " separators
+    # or ensure_ascii). json.dumps gives the same bytes as json.dump but uses the C encoder in one go,
+    # where json.dump goes through the pure Python iterencode
+    return json.dumps(data)
+
+def minify_specs(openapi_specs):
+
+    # Each spec is loaded, minified and written before the next one is loaded
+    # Only the endpoint metadata is kept to build the keypoint guide of each output directory
+    guide_endpoints_by_directory = defaultdict(lambda: defaultdict(list))
+    tag_summary_by_directory = defaultdict(dict)
+
+    try:
+        for openapi_spec in openapi_specs:
+            # Create list of processed and parsed individual endpoints
+            endpoints_by_tag_metadata, tag_summary_dict = minify(openapi_spec)
+
+            endpoints_by_tag_metadata, root_output_directory = create_endpoint_files(endpoints_by_tag_metadata, openapi_spec)
+            if balanced_chunks_enabled:
+                create_balanced_chunks(endpoints_by_tag_metadata, root_output_directory)
+
+            for tag, endpoints_with_tag in endpoints_by_tag_metadata.items():
+                guide_endpoints_by_directory[root_output_directory][tag].extend(
+                    {'metadata': endpoint['metadata'], 'source': guide_source(endpoint['source'])}
+                    for endpoint in endpoints_with_tag
+                )
+            for tag, tag_description in tag_summary_dict.items():
+                # Keep the first non empty description when several specs share a tag
+                if not tag_summary_by_directory[root_output_directory].get(tag):
+                    tag_summary_by_directory[root_output_directory][tag] = tag_description
+
+            if stage_report_enabled:
+                collect_stage_counts(endpoints_by_tag_metadata, root_output_directory)
+            if search_index_enabled:
+                collect_search_terms(endpoints_by_tag_metadata, root_output_directory)
+            if export_enabled:
+                collect_export_rows(endpoints_by_tag_metadata, root_output_directory)
+
+            # Release this spec before the loop loads the next one
+            del openapi_spec, endpoints_by_tag_metadata, tag_summary_dict
+    finally:
+        # Endpoint files still queued are written even if a spec failed, a failed write raises here
+        wait_for_file_writes()
+
+    for root_output_directory, endpoints_by_tag_metadata in guide_endpoints_by_directory.items():
+        # Sort the data
+        sorted_items = sorted(endpoints_by_tag_metadata.items())
+        sorted_endpoints_by_tag_metadata_dict = defaultdict(list, sorted_items)
+        sorted_items = sorted(tag_summary_by_directory[root_output_directory].items())
+        sorted_tag_summary_dict = defaultdict(str, sorted_items)
+
+        create_key_point_guide(sorted_endpoints_by_tag_metadata_dict, sorted_tag_summary_dict, root_output_directory)
+        if guide_index_enabled or guide_mode == 'tiered':
+            create_guide_index(sorted_endpoints_by_tag_metadata_dict, root_output_directory)
+    close_archives()
+    if incremental_enabled:
+        save_manifests()
+    if stage_report_enabled:
+        write_stage_reports()
+    if search_index_enabled:
+        write_search_indexes()
+    if export_enabled:
+        write_export_batches()
+    if doc_numbering == 'stable':
+        save_doc_number_maps()
+    if staged_output_enabled:
+        publish_staged_directories()
     count_tokens_in_directory(f'{output_directory}')
-    
+
 def minify(openapi_spec):
     
     server_url = openapi_spec['servers'][0]['url']  # Fetch the server URL from the openapi_spec specification
@@ -138,6 +616,8 @@ def minify(openapi_spec):
     endpoints_by_tag = defaultdict(list)
     endpoints_by_tag_metadata = defaultdict(list)
     endpoint_counter = 0
+    # Endpoints to process, in spec order
+    endpoint_jobs = []
     for path, methods in openapi_spec['paths'].items():
         for method, endpoint in methods.items():
             if method not in methods_to_handle:
@@ -145,57 +625,92 @@ def minify(openapi_spec):
             if endpoint.get('deprecated', False) and not keys_to_keep["deprecated"]:
                 continue
             endpoint_counter += 1
-            
-            # Adds schema to each endpoint
-            if keys_to_keep["schemas"]:
-                extracted_endpoint_data = resolve_refs(openapi_spec, endpoint)
-            else:
-                extracted_endpoint_data = endpoint
-            
-            # Populate output list with desired keys
-            extracted_endpoint_data = populate_keys(extracted_endpoint_data, path)
-
-            # If key == None or key == ''
-            extracted_endpoint_data = remove_empty_keys(extracted_endpoint_data)
-
-            # Remove unwanted keys
-            extracted_endpoint_data = remove_unnecessary_keys(extracted_endpoint_data)
-
-            # Flattens to remove nested objects where the dict has only one key
-            extracted_endpoint_data = flatten_endpoint(extracted_endpoint_data)
-            
-            if key_abbreviations_enabled:
-                # Replace common keys with abbreviations and sets all text to lower case
-                extracted_endpoint_data = abbreviate(extracted_endpoint_data, key_abbreviations)
-            
-            # Get the tags of the current endpoint
-            tags = endpoint.get('tags', [])
-            tags = [tag for tag in tags]
-            if not tags:
-                tag = 'default'
-            # For each tag, add the finalized endpoint to the corresponding list in the dictionary
-            for tag in tags:
-                endpoints_by_tag[tag].append(extracted_endpoint_data)
+            endpoint_jobs.append((path, method))
+
+    # Components used by many endpoints are written once as their own documents, see find_shared_components
+    shared_components = {}
+    if shared_schemas_enabled and keys_to_keep["schemas"]:
+        shared_components = find_shared_components(openapi_spec, endpoint_jobs)
+    # Endpoints get a stub with the schemaId in place of a shared component
+    shared_schema_stubs = {ref: shared_schema_stub(ref, schema_id) for ref, schema_id in shared_components.items()}
+
+    # Endpoints unchanged since the last incremental run reuse their previous content instead of being minified again
+    operation_hashes = [None] * len(endpoint_jobs)
+    reused_contents = {}
+    if incremental_enabled:
+        root_output_directory = get_root_output_directory(openapi_spec)
+        operation_hashes = get_operation_hashes(openapi_spec, endpoint_jobs, shared_components)
+        for index, (path, method) in enumerate(endpoint_jobs):
+            operation_id = openapi_spec['paths'][path][method].get('operationId', '').lower()
+            content_string = load_unchanged_content(
+                root_output_directory, operation_key(server_url, path, method), operation_hashes[index],
+                operation_id, f'{server_url}{path}'
+            )
+            if content_string is not None:
+                reused_contents[index] = content_string
+        print(f'{len(reused_contents)} endpoints unchanged')
+    pending_jobs = [endpoint_job for index, endpoint_job in enumerate(endpoint_jobs) if index not in reused_contents]
+
+    if parallel_workers is not None and parallel_workers > 1:
+        minified_endpoints = minify_endpoints_parallel(openapi_spec, pending_jobs, shared_schema_stubs)
+    else:
+        # Resolved $ref targets and their names, shared by all endpoints of this spec
+        resolved_components = dict(shared_schema_stubs)
+        component_cycles = {}
+        minified_endpoints = (
+            minify_endpoint(openapi_spec, path, openapi_spec['paths'][path][method], resolved_components, component_cycles)
+            for path, method in pending_jobs
+        )
+    minified_endpoints = iter(minified_endpoints)
+
+    for index, (path, method) in enumerate(endpoint_jobs):
+        endpoint = openapi_spec['paths'][path][method]
+        if index in reused_contents:
+            extracted_endpoint_data, content_string, stage_counts = None, reused_contents[index], None
+        else:
+            extracted_endpoint_data, content_string, stage_counts = next(minified_endpoints)
+
+        # Get the tags of the current endpoint
+        tags = endpoint.get('tags', [])
+        tags = [tag for tag in tags]
+        if not tags:
+            tag = 'default'
+        # For each tag, add the finalized endpoint to the corresponding list in the dictionary
+        for tag in tags:
+            endpoints_by_tag[tag].append(extracted_endpoint_data)
 
-            operation_id = endpoint.get('operationId', '').lower()
+        operation_id = endpoint.get('operationId', '').lower()
 
-            api_url = api_url_format.format(tag=tag, operationId=operation_id)
+        api_url = api_url_format.format(tag=tag, operationId=operation_id)
 
-            content_string = write_dict_to_text(extracted_endpoint_data)
-            metadata = {
-                'tag': tag,
-                'tag_number': 0,
-                'doc_number': 0,
-                'operation_id': operation_id,
-                'doc_url': api_url,
-                'server_url': f'{server_url}{path}'
-            }
-            endpoint_dict = {
-                "metadata": metadata,
-                "content": content_string
+        metadata = {
+            'tag': tag,
+            'tag_number': 0,
+            'doc_number': 0,
+            'operation_id': operation_id,
+            'doc_url': api_url,
+            'server_url': f'{server_url}{path}'
+        }
+        endpoint_dict = {
+            "metadata": metadata,
+            "content": content_string,
+            # Not written to the output, see endpoint_document
+            "source": {
+                'key': operation_key(server_url, path, method),
+                'method': method,
+                'path': path,
+                'hash': operation_hashes[index],
+                'stages': stage_counts
             }
+        }
+
+        endpoints_by_tag_metadata[tag].append(endpoint_dict)
 
-            endpoints_by_tag_metadata[tag].append(endpoint_dict)
+    if shared_components:
+        endpoints_by_tag_metadata[shared_schema_tag].extend(
+            create_shared_schema_documents(openapi_spec, shared_components, shared_schema_stubs)
+        )
+        tag_summary_dict[shared_schema_tag] = shared_schema_tag_description
 
     # Sort alphabetically by tag name
     sorted_items = sorted(endpoints_by_tag.items())
@@ -213,34 +728,320 @@ def minify(openapi_spec):
     print(f'{endpoint_counter} endpoints found')
     return endpoints_by_tag_metadata, tag_summary_dict
             
-def resolve_refs(openapi_spec, endpoint):
-    if isinstance(endpoint, dict):
-        new_endpoint = {}
-        for key, value in endpoint.items():
-            if key == '$ref':
-                ref_path = value.split('/')[1:]
-                ref_object = openapi_spec
-                for p in ref_path:
-                    ref_object = ref_object.get(p, {})
-                
-                # Recursively resolve references inside the ref_object
-                ref_object = resolve_refs(openapi_spec, ref_object)
+def minify_endpoint(openapi_spec, path, endpoint, resolved_components, component_cycles):
+    # Token and byte counts after each step, only collected for the stage report
+    stage_counts = {} if stage_report_enabled else None
+    if stage_counts is not None:
+        measure_stage(stage_counts, 'raw', endpoint)
+
+    # Adds schema to each endpoint
+    if keys_to_keep["schemas"]:
+        extracted_endpoint_data = resolve_refs(openapi_spec, endpoint, resolved_components, component_cycles)
+    else:
+        extracted_endpoint_data = endpoint
+    if stage_counts is not None:
+        measure_stage(stage_counts, 'refs_resolved', extracted_endpoint_data)
 
+    if fused_transforms_enabled and stage_counts is None:
+        # Does everything in the else branch in a single walk
+        extracted_endpoint_data = transform_endpoint(extracted_endpoint_data, path)
+    else:
+        # Populate output list with desired keys
+        extracted_endpoint_data = populate_keys(extracted_endpoint_data, path)
+        if stage_counts is not None:
+            measure_stage(stage_counts, 'populated', extracted_endpoint_data)
+
+        # If key == None or key == ''
+        extracted_endpoint_data = remove_empty_keys(extracted_endpoint_data)
+
+        # Remove unwanted keys
+        extracted_endpoint_data = remove_unnecessary_keys(extracted_endpoint_data)
+        if stage_counts is not None:
+            measure_stage(stage_counts, 'pruned', extracted_endpoint_data)
+
+        # Flattens to remove nested objects where the dict has only one key
+        extracted_endpoint_data = flatten_endpoint(extracted_endpoint_data)
+        if stage_counts is not None:
+            measure_stage(stage_counts, 'flattened', extracted_endpoint_data)
+
+        if key_abbreviations_enabled:
+            # Replace common keys with abbreviations and sets all text to lower case
+            extracted_endpoint_data = abbreviate(extracted_endpoint_data, key_abbreviations)
+        if stage_counts is not None:
+            measure_stage(stage_counts, 'abbreviated', extracted_endpoint_data)
+
+    content_string = write_dict_to_text(extracted_endpoint_data)
+    if stage_counts is not None:
+        measure_stage(stage_counts, 'rendered', content_string)
+    return extracted_endpoint_data, content_string, stage_counts
+
+def measure_stage(stage_counts, stage, data):
+    # Structured stages are measured as the JSON they would be if pasted into a prompt
+    text = data if isinstance(data, str) else json.dumps(data, default=str)
+    stage_counts[stage] = {
+        'bytes': len(text.encode('utf-8')),
+        'tokens': tiktoken_len(text)
+    }
+
+def minify_endpoints_parallel(openapi_spec, endpoint_jobs, shared_schema_stubs):
+    # Workers get the spec and the current settings once, then only (path, method) pairs are sent over
+    # executor.map keeps the results in the same order as endpoint_jobs
+    settings = {name: globals()[name] for name in worker_settings}
+    with ProcessPoolExecutor(
+        max_workers=parallel_workers,
+        initializer=init_minify_worker,
+        initargs=(openapi_spec, settings, shared_schema_stubs)
+    ) as executor:
+        return list(executor.map(minify_endpoint_job, endpoint_jobs, chunksize=parallel_chunk_size))
+
+def init_minify_worker(openapi_spec, settings, shared_schema_stubs):
+    global worker_openapi_spec, worker_resolved_components, worker_component_cycles
+    globals().update(settings)
+    worker_openapi_spec = openapi_spec
+    # Each worker keeps its own component cache for the whole spec
+    worker_resolved_components = dict(shared_schema_stubs)
+    worker_component_cycles = {}
+
+def minify_endpoint_job(endpoint_job):
+    path, method = endpoint_job
+    endpoint = worker_openapi_spec['paths'][path][method]
+    return minify_endpoint(worker_openapi_spec, path, endpoint, worker_resolved_components, worker_component_cycles)
+
+def resolve_refs(openapi_spec, endpoint, resolved_components=None, component_cycles=None, ref=None):
+    # Returns a copy of endpoint with each {'$ref': ref} replaced by {name: resolved component}
+    # resolved_components is shared by minify() across every endpoint of a spec so each $ref target is only expanded once
+    # The cached objects are shared between endpoints, remove_empty_keys copies them before anything is mutated
+    # ref is the component endpoint belongs to when it's the schema of a component rather than an endpoint
+    # Past ref_expansion_max_depth nested refs or ref_expansion_max_nodes nodes a referenced schema becomes a stub
+    if resolved_components is None:
+        resolved_components = {}
+    # Cycle of each component, see find_component_cycles. Shared like resolved_components
+    if component_cycles is None:
+        component_cycles = {}
+    cycle = None
+    if ref is not None:
+        cycle = component_cycle(openapi_spec, ref, component_cycles)
+    # Nodes copied into this endpoint so far, only counted when there's a limit
+    node_count = [0] if ref_expansion_max_nodes is not None else None
+    return resolve_refs_in(
+        openapi_spec, endpoint, resolved_components, component_cycles, (cycle, False, ref_expansion_max_depth), node_count
+    )[0]
+
+def resolve_refs_in(openapi_spec, data, resolved_components, component_cycles, expansion, node_count):
+    # Returns the resolved data and the number of dicts, lists and values in it
+    # expansion is (cycle, in_cycle, depth_left): the cycle of the component data belongs to, whether that component
+    # was reached from its own cycle and how many more nested refs may be expanded, None for no limit
+    # A component on a $ref cycle is expanded with the other components of its cycle expanded one level, their refs
+    # back into the cycle become stubs. That only depends on the component and expansion, not on the path it was
+    # reached by, so every expansion is cached and endpoints render the same whichever ran first
+    # node_count is None or the nodes of the endpoint counted so far, in the order they're written
+    if node_count is not None:
+        node_count[0] += 1
+    data_node_count = 1
+    if isinstance(data, dict):
+        new_data = {}
+        for key, value in data.items():
+            if key == '$ref':
                 # Use the last part of the reference path as key
-                new_key = ref_path[-1]
-                new_endpoint[new_key] = ref_object
+                key = value.split('/')[-1]
+                value, value_node_count = resolve_ref(
+                    openapi_spec, value, resolved_components, component_cycles, expansion, node_count
+                )
             else:
                 # Recursively search in nested dictionaries
-                new_endpoint[key] = resolve_refs(openapi_spec, value)
-        return new_endpoint
+                value, value_node_count = resolve_refs_in(
+                    openapi_spec, value, resolved_components, component_cycles, expansion, node_count
+                )
+            new_data[key] = value
+            data_node_count += value_node_count
+        return new_data, data_node_count
 
-    elif isinstance(endpoint, list):
+    elif isinstance(data, list):
         # Recursively search in lists
-        return [resolve_refs(openapi_spec, item) for item in endpoint]
+        new_list = []
+        for item in data:
+            item, item_node_count = resolve_refs_in(
+                openapi_spec, item, resolved_components, component_cycles, expansion, node_count
+            )
+            new_list.append(item)
+            data_node_count += item_node_count
+        return new_list, data_node_count
 
     else:
-        # Base case: return the endpoint as is if it's neither a dictionary nor a list
-        return endpoint
+        # Base case: return the data as is if it's neither a dictionary nor a list
+        return data, data_node_count
+
+def resolve_ref(openapi_spec, ref, resolved_components, component_cycles, expansion, node_count):
+    # Shared schema stubs are cached under the plain ref, expansions under (ref, in_cycle, depth_left)
+    cycle, in_cycle, depth_left = expansion
+    ref_name = ref.split('/')[-1]
+    if ref in resolved_components:
+        return resolve_refs_in(openapi_spec, resolved_components[ref], resolved_components, component_cycles, expansion, node_count)
+    ref_cycle = component_cycle(openapi_spec, ref, component_cycles)
+    ref_in_cycle = ref_cycle is not None and ref_cycle == cycle
+    if ref_in_cycle and in_cycle:
+        # Second step around a cycle
+        return resolve_refs_in(openapi_spec, ref_stub(ref_name), resolved_components, component_cycles, expansion, node_count)
+
+    ref_object = lookup_ref(openapi_spec, ref)
+    if isinstance(ref_object, (dict, list)):
+        # Keeps recursive or machine generated schema graphs from blowing up the endpoint
+        if (depth_left is not None and depth_left <= 0) or (node_count is not None and node_count[0] >= ref_expansion_max_nodes):
+            return ref_stub(ref_name), 0
+        if depth_left is not None:
+            depth_left -= 1
+    ref_expansion = (ref_cycle, ref_in_cycle, depth_left)
+    key = (ref, ref_in_cycle, depth_left)
+    if key not in resolved_components:
+        # Recursively resolve references inside the referenced object, with every node it can reach
+        resolved_components[key] = resolve_refs_in(
+            openapi_spec, ref_object, resolved_components, component_cycles, ref_expansion, None
+        )
+    resolved_component, component_node_count = resolved_components[key]
+    if node_count is None or node_count[0] + component_node_count <= ref_expansion_max_nodes:
+        if node_count is not None:
+            node_count[0] += component_node_count
+        return resolved_component, component_node_count
+    # The node limit is reached somewhere inside, only this endpoint gets this copy
+    return resolve_refs_in(openapi_spec, ref_object, resolved_components, component_cycles, ref_expansion, node_count)
+
+def component_cycle(openapi_spec, ref, component_cycles):
+    if ref not in component_cycles:
+        find_component_cycles(openapi_spec, ref, component_cycles)
+    return component_cycles[ref]
+
+def find_component_cycles(openapi_spec, ref, component_cycles):
+    # Tarjan's strongly connected components over the $ref graph reachable from ref, skipping components seen before.
+    # Every component on a cycle gets the smallest ref of its cycle as its cycle, every other component None
+    component_refs = {}
+    indexes = {}
+    lowlinks = {}
+    stack = []
+    on_stack = set()
+
+    def visit(component_ref):
+        indexes[component_ref] = lowlinks[component_ref] = len(indexes)
+        stack.append(component_ref)
+        on_stack.add(component_ref)
+        component_refs[component_ref] = find_refs(lookup_ref(openapi_spec, component_ref))
+        return component_ref, iter(sorted(component_refs[component_ref]))
+
+    # Explicit stack of (ref, iterator over the refs it uses), long chains of refs can't hit the recursion limit
+    visits = [visit(ref)]
+    while visits:
+        component_ref, used_refs = visits[-1]
+        for used_ref in used_refs:
+            if used_ref in component_cycles:
+                continue
+            if used_ref not in indexes:
+                visits.append(visit(used_ref))
+                break
+            if used_ref in on_stack:
+                lowlinks[component_ref] = min(lowlinks[component_ref], indexes[used_ref])
+        else:
+            visits.pop()
+            if visits:
+                parent_ref = visits[-1][0]
+                lowlinks[parent_ref] = min(lowlinks[parent_ref], lowlinks[component_ref])
+            if lowlinks[component_ref] == indexes[component_ref]:
+                members = []
+                while not members or members[-1] != component_ref:
+                    members.append(stack.pop())
+                    on_stack.discard(members[-1])
+                is_cycle = len(members) > 1 or component_ref in component_refs[component_ref]
+                for member in members:
+                    component_cycles[member] = min(members) if is_cycle else None
+
+def lookup_ref(openapi_spec, ref):
+    ref_object = openapi_spec
+    for p in ref.split('/')[1:]:
+        ref_object = ref_object.get(p, {})
+    return ref_object
+
+def ref_stub(ref_name):
+    # Placeholder used in place of a schema that is not expanded inline
+    return {'schemaName': ref_name}
+
+def find_shared_components(openapi_spec, endpoint_jobs):
+    # Components referenced, directly or through other components, by at least shared_schema_min_reuse endpoints
+    # and whose resolved text is at least shared_schema_min_tokens tokens. Returns {ref: schema_id}
+    component_refs = {}
+    reuse_counts = defaultdict(int)
+    for path, method in endpoint_jobs:
+        for ref in referenced_components(openapi_spec, openapi_spec['paths'][path][method], component_refs):
+            reuse_counts[ref] += 1
+
+    candidate_refs = sorted(ref for ref, reuse_count in reuse_counts.items() if reuse_count >= shared_schema_min_reuse)
+    resolved_components = {}
+    component_cycles = {}
+    candidate_texts = []
+    for ref in candidate_refs:
+        resolved_component = resolve_refs(openapi_spec, lookup_ref(openapi_spec, ref), resolved_components, component_cycles, ref)
+        candidate_texts.append(write_dict_to_text(resolved_component))
+
+    shared_refs = [
+        ref for ref, token_count in zip(candidate_refs, tiktoken_len_batch(candidate_texts))
+        if token_count >= shared_schema_min_tokens
+    ]
+    print(f'{len(shared_refs)} shared schemas, saving {sum(reuse_counts[ref] - 1 for ref in shared_refs)} inlined copies')
+    output_directory_path = get_output_directory_path(openapi_spec)
+    return {ref: shared_schema_id(output_directory_path, ref) for ref in shared_refs}
+
+def shared_schema_id(output_directory_path, ref):
+    # A hash of the ref, so a component keeps its schemaId when other components start or stop being shared
+    # Specs with the same server share an output directory, a ref given out there already by another spec is hashed again
+    taken_schema_ids = shared_schema_ids[output_directory_path]
+    key = ref
+    attempt = 0
+    while True:
+        schema_id = f"schema{hashlib.blake2b(key.encode('utf-8'), digest_size=4).hexdigest()}"
+        if schema_id not in taken_schema_ids:
+            taken_schema_ids.add(schema_id)
+            return schema_id
+        attempt += 1
+        key = f'{ref} {attempt}'
+
+def shared_schema_stub(ref, schema_id):
+    # Placeholder for a shared component, the schemaId is the operation id of its document in the keypoint guide
+    return {'schemaName': ref.split('/')[-1], 'schemaId': schema_id}
+
+def create_shared_schema_documents(openapi_spec, shared_components, shared_schema_stubs):
+    # One document per shared component, built the same way as an endpoint. Other shared components used inside
+    # it stay stubs. Documents use the shared_schema_tag so they get doc_numbers and a line in the keypoint guide
+    server_url = openapi_spec['servers'][0]['url']
+    resolved_components = dict(shared_schema_stubs)
+    component_cycles = {}
+    shared_refs = list(shared_components)
+    operation_hashes = [None] * len(shared_refs)
+    if incremental_enabled:
+        operation_hashes = get_operation_hashes(openapi_spec, [(ref, None) for ref in shared_refs], shared_components)
+
+    documents = []
+    for ref, operation_hash in zip(shared_refs, operation_hashes):
+        schema_id = shared_components[ref]
+        resolved_component = resolve_refs(openapi_spec, lookup_ref(openapi_spec, ref), resolved_components, component_cycles, ref)
+        schema_data = {'schemaName': ref.split('/')[-1], 'schemaId': schema_id, 'schema': resolved_component}
+        abbreviations = key_abbreviations if key_abbreviations_enabled else None
+        schema_data = transform_dict(kept_items(schema_data, nested=False), abbreviations, flatten=True)
+
+        documents.append({
+            "metadata": {
+                'tag': shared_schema_tag,
+                'tag_number': 0,
+                'doc_number': 0,
+                'operation_id': schema_id,
+                'doc_url': '',
+                'server_url': server_url
+            },
+            "content": write_dict_to_text(schema_data),
+            "source": {
+                'key': operation_key(server_url, ref, 'schema'),
+                'method': None,
+                'path': ref,
+                'hash': operation_hash
+            }
+        })
+    return documents
 
 def populate_keys(endpoint, path):
     # Gets the main keys from the specs
@@ -375,17 +1176,79 @@ def abbreviate(data, abbreviations):
         # Return data unchanged if it's not a dict, list or string
         return data
 
+def transform_endpoint(endpoint, path):
+    # Single walk version of populate_keys -> remove_empty_keys -> remove_unnecessary_keys -> flatten_endpoint -> abbreviate
+    # Builds the final dict directly instead of a full copy of the endpoint per step
+    abbreviations = key_abbreviations if key_abbreviations_enabled else None
+    # populate_keys only touches the root level so it's cheap to reuse
+    populated_endpoint = populate_keys(endpoint, path)
+    return transform_dict(kept_items(populated_endpoint, nested=False), abbreviations, flatten=True)
+
+def kept_items(data, nested):
+    # The items of a dict that remove_empty_keys and remove_unnecessary_keys would leave in place
+    items = []
+    for key, value in data.items():
+        if value is None or value == '':
+            continue
+        if key == 'example' and not keys_to_keep["examples"]:
+            continue
+        if key == 'enum' and not keys_to_keep["enums"]:
+            continue
+        if key == 'description' and nested and not keys_to_keep["nested_descriptions"]:
+            continue
+        items.append((key, value))
+    return items
+
+def transform_dict(items, abbreviations, flatten):
+    # flatten_endpoint doesn't descend into lists, so flatten is False for dicts found inside a list
+    keep_keys = {"responses", "default", "200"}
+
+    transformed = {}
+    for key, value in items:
+        if isinstance(value, dict):
+            value_items = kept_items(value, nested=True)
+            # Same unwrapping as flatten_endpoint, but over the already filtered items
+            if flatten and not (key in keep_keys or (isinstance(key, str) and (key.startswith('5') or key.startswith('4')))):
+                while len(value_items) == 1:
+                    key, value = value_items[0]
+                    if not isinstance(value, dict):
+                        break
+                    value_items = kept_items(value, nested=True)
+            if isinstance(value, dict):
+                transformed[key] = transform_dict(value_items, abbreviations, flatten)
+                continue
+        if isinstance(value, list):
+            transformed[key] = transform_list(value, abbreviations)
+        elif abbreviations is not None:
+            transformed[key] = abbreviate(abbreviations.get(str(value).lower(), value), abbreviations)
+        else:
+            transformed[key] = value
+
+    if abbreviations is not None:
+        # Keys are abbreviated after flattening so colliding keys resolve the same way as in abbreviate
+        transformed = {abbreviations.get(key.lower(), key.lower()): value for key, value in transformed.items()}
+    return transformed
+
+def transform_list(items, abbreviations):
+    transformed = []
+    for item in items:
+        if isinstance(item, dict):
+            transformed.append(transform_dict(kept_items(item, nested=True), abbreviations, flatten=False))
+        elif isinstance(item, list):
+            transformed.append(transform_list(item, abbreviations))
+        elif abbreviations is not None:
+            transformed.append(abbreviate(item, abbreviations))
+        else:
+            transformed.append(item)
+    return transformed
+
 def create_endpoint_files(endpoints_by_tag_metadata, openapi_spec):
     
     # Creates a directory named after the API url
-    server_url = openapi_spec['servers'][0]['url']  
-    parsed_url = urlparse(server_url)
-    # If output_directory exists, delete it.
-    # If output_directory exists, delete it.
-    root_output_directory = os.path.join(output_directory, parsed_url.netloc)
+    root_output_directory = get_root_output_directory(openapi_spec)
 
-    # Initialize tag and operationId counters
-    global operationID_counter
+    if output_format in ('jsonl', 'archive'):
+        return create_endpoint_archive(endpoints_by_tag_metadata, root_output_directory)
     
     # Create a subdirectory for the operationIDs
     operationIDs_directory = os.path.join(root_output_directory, 'operationIDs')
@@ -397,65 +1260,545 @@ def create_endpoint_files(endpoints_by_tag_metadata, openapi_spec):
 
 
         for endpoint in endpoints_with_tag:
-            endpoint['metadata']['doc_number'] = operationID_counter
+            doc_number = next_doc_number(root_output_directory, endpoint)
+            endpoint['metadata']['doc_number'] = doc_number
    
             # Create a file name 
-            file_name = f"{tag}-{operationID_counter}.json"
+            file_name = f"{tag}-{doc_number}.json"
             # Define the file path
             file_path = os.path.join(operationIDs_directory, file_name)
+            relative_file_path = os.path.join('operationIDs', file_name)
 
-            # Write the data to a JSON file
-            with open(file_path, 'w') as file:
-                json.dump(endpoint, file)
+            if incremental_enabled and is_unchanged_file(root_output_directory, endpoint['source'], relative_file_path):
+                # Same endpoint hash and same doc_number, so the file on disk is already what would be written
+                pass
+            else:
+                # Write the data to a JSON file
+                write_document_file(file_path, endpoint_document(endpoint))
+
+            endpoint['source']['location'] = [relative_file_path, 0, 0]
+            if incremental_enabled:
+                record_manifest_entry(root_output_directory, endpoint['source'], relative_file_path, doc_number)
+
+    return endpoints_by_tag_metadata, root_output_directory
 
-            operationID_counter += 1
+def write_document_file(file_path, document):
+    global file_writer, file_writer_slots
+    if not file_writer_threads:
+        write_document(file_path, document)
+        return
+    if file_writer is None:
+        file_writer = ThreadPoolExecutor(max_workers=file_writer_threads, thread_name_prefix='file_writer')
+        file_writer_slots = threading.BoundedSemaphore(file_writer_max_pending)
+    # Blocks while file_writer_max_pending writes are still queued
+    file_writer_slots.acquire()
+    future = file_writer.submit(write_document, file_path, document)
+    future.add_done_callback(lambda future: file_writer_slots.release())
+    pending_file_writes.append((file_path, future))
+
+def write_document(file_path, document):
+    with open(file_path, 'w') as file:
+        file.write(json_dumps(document))
+
+def wait_for_file_writes():
+    # Waits for every queued write, then raises the error of the first failed write in the order they were queued,
+    # so the same failure is reported whichever thread hit it first
+    global file_writer
+    if file_writer is None:
+        return
+    file_writer.shutdown(wait=True)
+    file_writer = None
+    queued_writes = list(pending_file_writes)
+    pending_file_writes.clear()
+    for file_path, future in queued_writes:
+        error = future.exception()
+        if error is not None:
+            raise OSError(f"Failed to write {file_path}") from error
+
+def create_endpoint_archive(endpoints_by_tag_metadata, root_output_directory):
+    # Same documents and numbering as create_endpoint_files, written as lines of a single file
+    archive = open_archive(root_output_directory)
+
+    for tag, endpoints_with_tag in endpoints_by_tag_metadata.items():
+        for endpoint in endpoints_with_tag:
+            doc_number = next_doc_number(root_output_directory, endpoint)
+            endpoint['metadata']['doc_number'] = doc_number
+
+            # json_dumps escapes newlines and non ascii characters, so each document is exactly one ascii line
+            line = (json_dumps(endpoint_document(endpoint)) + '\n').encode('utf-8')
+            offset = archive['file'].tell()
+            archive['file'].write(line)
+            archive['index'][doc_number] = [offset, len(line)]
+            endpoint['source']['location'] = [archive_file_name, offset, len(line)]
+
+            if incremental_enabled:
+                record_manifest_entry(root_output_directory, endpoint['source'], archive_file_name, doc_number, offset, len(line))
 
     return endpoints_by_tag_metadata, root_output_directory
 
+def next_doc_number(root_output_directory, endpoint):
+    global operationID_counter
+    if doc_numbering == 'stable':
+        return stable_doc_number(root_output_directory, endpoint)
+    doc_number = operationID_counter
+    operationID_counter += 1
+    return doc_number
+
+def stable_doc_number(root_output_directory, endpoint):
+    # The number this endpoint had before, or a new one from the hash of its key, moving up on collisions
+    doc_number_map = load_doc_number_map(root_output_directory)
+    key = f"{endpoint['source']['key']} {endpoint['metadata']['operation_id']}"
+    if key not in doc_number_map['doc_numbers']:
+        number_count = 10 ** stable_doc_number_digits
+        doc_number = int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little') % number_count
+        taken_doc_numbers = doc_number_map['taken']
+        if len(taken_doc_numbers) >= number_count:
+            raise ValueError(f"No doc_numbers left with {stable_doc_number_digits} digits")
+        while doc_number in taken_doc_numbers:
+            doc_number = (doc_number + 1) % number_count
+        doc_number_map['doc_numbers'][key] = doc_number
+        taken_doc_numbers.add(doc_number)
+    return doc_number_map['doc_numbers'][key]
+
+def load_doc_number_map(root_output_directory):
+    if root_output_directory not in doc_number_maps:
+        # A staged run writes into an empty version, the map is read from the version being replaced
+        published_directories = [
+            published_directory for published_directory, staging_directory in staged_directories.items()
+            if staging_directory == root_output_directory
+        ]
+        doc_numbers = {}
+        for directory in [root_output_directory] + published_directories:
+            try:
+                with open(os.path.join(directory, doc_number_map_file_name), 'rb') as file:
+                    doc_numbers = json_loads(file.read())
+                break
+            except (OSError, ValueError):
+                pass
+        doc_number_maps[root_output_directory] = {'doc_numbers': doc_numbers, 'taken': set(doc_numbers.values())}
+    return doc_number_maps[root_output_directory]
+
+def save_doc_number_maps():
+    # Numbers of removed endpoints stay in the map, so they aren't given to a different endpoint later
+    for root_output_directory, doc_number_map in doc_number_maps.items():
+        os.makedirs(root_output_directory, exist_ok=True)
+        with open(os.path.join(root_output_directory, doc_number_map_file_name), 'w') as file:
+            file.write(json_dumps(dict(sorted(doc_number_map['doc_numbers'].items()))))
+    doc_number_maps.clear()
+
+def open_archive(root_output_directory):
+    # Specs sharing an output directory append to the same archive during a run. It's written to a temporary
+    # file that close_archives moves into place, so the previous archive stays readable until the run is done
+    if root_output_directory not in archive_writers:
+        os.makedirs(root_output_directory, exist_ok=True)
+        archive_path = os.path.join(root_output_directory, archive_file_name)
+        archive_writers[root_output_directory] = {
+            'file': open(f'{archive_path}.tmp', 'wb'),
+            'index': {}
+        }
+    return archive_writers[root_output_directory]
+
+def close_archives():
+    for root_output_directory, archive in archive_writers.items():
+        archive['file'].close()
+        archive_path = os.path.join(root_output_directory, archive_file_name)
+        os.replace(f'{archive_path}.tmp', archive_path)
+        if output_format == 'archive':
+            # doc_number -> [byte offset, byte length] of its line in the archive
+            with open(os.path.join(root_output_directory, archive_index_file_name), 'w') as file:
+                file.write(json_dumps(archive['index']))
+    archive_writers.clear()
+    archive_indexes.clear()
+
+def read_archive_document(root_output_directory, doc_number):
+    # Random access to a single document of an 'archive' output
+    if root_output_directory not in archive_indexes:
+        with open(os.path.join(root_output_directory, archive_index_file_name), 'rb') as file:
+            archive_indexes[root_output_directory] = json_loads(file.read())
+    offset, length = archive_indexes[root_output_directory][str(doc_number)]
+    with open(os.path.join(root_output_directory, archive_file_name), 'rb') as file:
+        file.seek(offset)
+        return json_loads(file.read(length))
+
+def create_balanced_chunks(endpoints_by_tag_metadata, root_output_directory):
+    # Call after create_endpoint_files, the chunks list the doc_numbers of their endpoints
+    global chunk_counter
+
+    chunks_directory = os.path.join(root_output_directory, balanced_chunks_directory_name)
+    if root_output_directory not in chunk_directories_started:
+        # Chunk numbers aren't stable between runs, so old chunks are removed rather than overwritten
+        if os.path.exists(chunks_directory):
+            shutil.rmtree(chunks_directory)
+        chunk_directories_started.add(root_output_directory)
+    os.makedirs(chunks_directory, exist_ok=True)
+
+    for tag, endpoints_with_tag in endpoints_by_tag_metadata.items():
+        # Each endpoint is tokenized once, packing only works with the counts
+        contents = [endpoint['content'] for endpoint in endpoints_with_tag]
+        token_counts = tiktoken_len_batch(contents)
+        for index, endpoint in enumerate(endpoints_with_tag):
+            if token_counts[index] > token_count_max:
+                metadata = endpoint['metadata']
+                print(f'truncating: {metadata["operation_id"]}\n token count: {token_counts[index]}')
+                contents[index] = f'operationId {metadata["operation_id"]}\nendpoint spec too long see {metadata["doc_url"]} for more info'
+                token_counts[index] = tiktoken_len(contents[index])
+
+        chunks = pack_endpoints(token_counts, token_count_goal, token_count_max)
+        chunk_contents = ['\n'.join(contents[index] for index in chunk) for chunk in chunks]
+        for chunk, chunk_content, chunk_token_count in zip(chunks, chunk_contents, tiktoken_len_batch(chunk_contents)):
+            metadata = {
+                'tag': tag,
+                'chunk_number': chunk_counter,
+                'doc_numbers': [endpoints_with_tag[index]['metadata']['doc_number'] for index in chunk],
+                'operation_ids': [endpoints_with_tag[index]['metadata']['operation_id'] for index in chunk],
+                'token_count': chunk_token_count
+            }
+            file_path = os.path.join(chunks_directory, f"{tag}-{chunk_counter}.json")
+            with open(file_path, 'w') as file:
+                file.write(json_dumps({"metadata": metadata, "content": chunk_content}))
+            chunk_counter += 1
+
+def pack_endpoints(token_counts, goal, maximum):
+    # Groups endpoint indexes into chunks of about goal tokens, no chunk goes over maximum unless a single endpoint does.
+    # Places the largest endpoints first, each into the fullest chunk it still fits in under goal, or a new chunk
+    # (best fit decreasing). Chunks left under half the goal are then folded into chunks with room under maximum.
+    # Chunk sizes are kept in a sorted list, so finding the best fit is a binary search.
+    # Every endpoint after the first in a chunk also costs about one token for the newline joining them
+    sizes = [token_count + 1 for token_count in token_counts]
+    chunks = []
+    chunk_totals = []
+    # (size, chunk index) of every chunk, ascending
+    chunk_sizes = []
+
+    def best_fit(size, capacity):
+        # Index in chunk_sizes of the fullest chunk with room for size under capacity, or None
+        position = bisect.bisect_right(chunk_sizes, (capacity - size, len(chunks))) - 1
+        return position if position >= 0 else None
+
+    def add_to_chunk(chunk_index, index):
+        if chunk_index == len(chunks):
+            chunks.append([])
+            chunk_totals.append(0)
+        else:
+            chunk_sizes.remove((chunk_totals[chunk_index], chunk_index))
+        chunks[chunk_index].append(index)
+        chunk_totals[chunk_index] += sizes[index]
+        bisect.insort(chunk_sizes, (chunk_totals[chunk_index], chunk_index))
+
+    for index in sorted(range(len(sizes)), key=lambda index: sizes[index], reverse=True):
+        position = best_fit(sizes[index], goal)
+        add_to_chunk(len(chunks) if position is None else chunk_sizes[position][1], index)
+
+    # Smallest chunks first, a chunk is only folded if all of its endpoints find room in the others
+    for chunk_index in sorted(range(len(chunks)), key=lambda chunk_index: chunk_totals[chunk_index]):
+        if chunk_totals[chunk_index] * 2 >= goal or len(chunk_sizes) == 1:
+            continue
+        targets = []
+        target_totals = {}
+        for index in sorted(chunks[chunk_index], key=lambda index: sizes[index], reverse=True):
+            # Best fit among the other chunks, counting what was already given to them
+            candidates = [
+                (target_totals.get(other_index, other_total) + sizes[index], other_index)
+                for other_total, other_index in chunk_sizes
+                if other_index != chunk_index and target_totals.get(other_index, other_total) + sizes[index] <= maximum
+            ]
+            if not candidates:
+                break
+            new_total, target_index = max(candidates)
+            target_totals[target_index] = new_total
+            targets.append((target_index, index))
+        else:
+            chunk_sizes.remove((chunk_totals[chunk_index], chunk_index))
+            chunks[chunk_index] = []
+            chunk_totals[chunk_index] = 0
+            for target_index, index in targets:
+                add_to_chunk(target_index, index)
+
+    # Endpoints keep their spec order inside a chunk and chunks are ordered by their first endpoint
+    return sorted((sorted(chunk) for chunk in chunks if chunk), key=lambda chunk: chunk[0])
+
+def get_root_output_directory(openapi_spec):
+    root_output_directory = get_output_directory_path(openapi_spec)
+    if staged_output_enabled:
+        return get_staging_directory(root_output_directory)
+    return root_output_directory
+
+def get_output_directory_path(openapi_spec):
+    # Where the output of a spec ends up, get_root_output_directory is where this run writes it
+    server_url = openapi_spec['servers'][0]['url']  
+    parsed_url = urlparse(server_url)
+    return os.path.join(output_directory, parsed_url.netloc)
+
+def get_staging_directory(root_output_directory):
+    # The new version of root_output_directory written by this run, publish_staged_directories swaps it in
+    if root_output_directory not in staged_directories:
+        versions_directory = os.path.join(output_directory, staged_versions_directory_name)
+        os.makedirs(versions_directory, exist_ok=True)
+        staging_directory = tempfile.mkdtemp(prefix=f'{os.path.basename(root_output_directory)}.', dir=versions_directory)
+        os.chmod(staging_directory, 0o755)
+        if incremental_enabled and os.path.isdir(root_output_directory):
+            # Start from the current version so unchanged endpoints and the manifest carry over.
+            # Files are copied rather than linked since changed endpoints are rewritten in place
+            shutil.copytree(root_output_directory, staging_directory, dirs_exist_ok=True)
+        staged_directories[root_output_directory] = staging_directory
+    return staged_directories[root_output_directory]
+
+def publish_staged_directories():
+    # Flushes each new version to disk, then points its output directory at it with a single rename
+    for root_output_directory, staging_directory in staged_directories.items():
+        fsync_directory_tree(staging_directory)
+        if os.path.isdir(root_output_directory) and not os.path.islink(root_output_directory):
+            # Written before staged output was enabled. Moved into the versions once, a symlink can't replace a directory
+            os.rename(root_output_directory, tempfile.mkdtemp(
+                prefix=f'{os.path.basename(root_output_directory)}.',
+                dir=os.path.dirname(staging_directory)
+            ))
+        link_path = os.path.join(output_directory, f'.{os.path.basename(root_output_directory)}.link')
+        if os.path.lexists(link_path):
+            os.remove(link_path)
+        # Relative, so the output directory can be moved or mounted elsewhere
+        os.symlink(os.path.relpath(staging_directory, output_directory), link_path)
+        os.replace(link_path, root_output_directory)
+        fsync_directory(output_directory)
+        # Indexes were written to the staging directory, lookups by the output directory still hold the replaced version
+        previous_index = guide_indexes.pop(root_output_directory, None)
+        if previous_index is not None:
+            previous_index.close()
+        search_indexes.pop(root_output_directory, None)
+        remove_old_versions(root_output_directory, staging_directory)
+    staged_directories.clear()
+
+def remove_old_versions(root_output_directory, current_version):
+    # Versions left by earlier runs, including any from a run that crashed before publishing, newest first
+    versions_directory = os.path.dirname(current_version)
+    version_pattern = re.compile(re.escape(os.path.basename(root_output_directory)) + r'\.[a-z0-9_]{8}')
+    old_versions = [
+        os.path.join(versions_directory, name)
+        for name in os.listdir(versions_directory)
+        if version_pattern.fullmatch(name) and name != os.path.basename(current_version)
+    ]
+    old_versions.sort(key=os.path.getmtime, reverse=True)
+    for old_version in old_versions[staged_versions_kept:]:
+        shutil.rmtree(old_version, ignore_errors=True)
+
+def fsync_directory_tree(directory):
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for filename in filenames:
+            file_descriptor = os.open(os.path.join(dirpath, filename), os.O_RDONLY)
+            try:
+                os.fsync(file_descriptor)
+            finally:
+                os.close(file_descriptor)
+        fsync_directory(dirpath)
+
+def fsync_directory(directory):
+    # Makes new, renamed and removed entries of a directory durable
+    file_descriptor = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(file_descriptor)
+    finally:
+        os.close(file_descriptor)
+
+def endpoint_document(endpoint):
+    # The part of an endpoint dict that goes into the output, source is only used while building it
+    return {
+        "metadata": endpoint['metadata'],
+        "content": endpoint['content']
+    }
+
+def operation_key(server_url, path, method):
+    return f'{method.upper()} {server_url}{path}'
+
+def get_operation_hashes(openapi_spec, endpoint_jobs, shared_components=None):
+    # One hash per endpoint covering everything its output depends on: the settings, the server url,
+    # the endpoint itself and every component it references directly or through other components
+    # A job with method None is a shared schema, (ref, None)
+    # Shared components are part of the hash of the operations that reference them, with their schemaId
+    shared_components = shared_components or {}
+    settings = {name: globals()[name] for name in output_settings}
+    settings_hash = hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode('utf-8')).digest()
+    server_url = openapi_spec['servers'][0]['url']
+    component_refs = {}
+    component_hashes = {}
+
+    operation_hashes = []
+    for path, method in endpoint_jobs:
+        if method is None:
+            endpoint = lookup_ref(openapi_spec, path)
+        else:
+            endpoint = openapi_spec['paths'][path][method]
+        operation_hash = hashlib.sha256(settings_hash)
+        operation_hash.update(json.dumps([server_url, path, method, endpoint], sort_keys=True, default=str).encode('utf-8'))
+        if method is None:
+            # The document of a shared component has its own schemaId in it
+            operation_hash.update(shared_components[path].encode('utf-8'))
+        for ref in sorted(referenced_components(openapi_spec, endpoint, component_refs)):
+            if ref not in component_hashes:
+                component = json.dumps(lookup_ref(openapi_spec, ref), sort_keys=True, default=str)
+                component_hashes[ref] = hashlib.sha256(component.encode('utf-8')).digest()
+            operation_hash.update(ref.encode('utf-8'))
+            operation_hash.update(component_hashes[ref])
+            if ref in shared_components:
+                operation_hash.update(shared_components[ref].encode('utf-8'))
+        operation_hashes.append(operation_hash.hexdigest())
+    return operation_hashes
+
+def referenced_components(openapi_spec, endpoint, component_refs):
+    # Transitive closure of the $refs used by an endpoint, component_refs caches the direct refs of each component
+    found_refs = set()
+    stack = list(find_refs(endpoint))
+    while stack:
+        ref = stack.pop()
+        if ref in found_refs:
+            continue
+        found_refs.add(ref)
+        if ref not in component_refs:
+            component_refs[ref] = find_refs(lookup_ref(openapi_spec, ref))
+        stack.extend(component_refs[ref])
+    return found_refs
+
+def find_refs(data):
+    refs = set()
+    stack = [data]
+    while stack:
+        current_data = stack.pop()
+        if isinstance(current_data, dict):
+            for key, value in current_data.items():
+                if key == '$ref' and isinstance(value, str):
+                    refs.add(value)
+                elif isinstance(value, (dict, list)):
+                    stack.append(value)
+        elif isinstance(current_data, list):
+            stack.extend(item for item in current_data if isinstance(item, (dict, list)))
+    return refs
+
+def load_manifest(root_output_directory):
+    # Manifest written by the previous incremental run, loaded once per output directory
+    if root_output_directory not in previous_manifests:
+        manifest_path = os.path.join(root_output_directory, manifest_file_name)
+        try:
+            with open(manifest_path, 'rb') as file:
+                previous_manifests[root_output_directory] = json_loads(file.read())
+        except (OSError, ValueError):
+            previous_manifests[root_output_directory] = {'operations': {}}
+    return previous_manifests[root_output_directory]
+
+def load_unchanged_content(root_output_directory, key, operation_hash, operation_id, endpoint_server_url):
+    # Returns the previously written content of an endpoint if its hash hasn't changed, otherwise None
+    entry = load_manifest(root_output_directory)['operations'].get(key)
+    if entry is None or entry['hash'] != operation_hash:
+        return None
+    try:
+        with open(os.path.join(root_output_directory, entry['file']), 'rb') as file:
+            if 'offset' in entry:
+                # The document is a line of an archive
+                file.seek(entry['offset'])
+                document = json_loads(file.read(entry['length']))
+            else:
+                document = json_loads(file.read())
+    except (OSError, ValueError):
+        return None
+    # Another endpoint may have been written to this file name earlier in this run
+    metadata = document.get('metadata', {})
+    if metadata.get('operation_id') != operation_id or metadata.get('server_url') != endpoint_server_url:
+        return None
+    return document.get('content')
+
+def is_unchanged_file(root_output_directory, source, relative_file_path):
+    entry = load_manifest(root_output_directory)['operations'].get(source['key'])
+    return (
+        entry is not None
+        and entry['hash'] == source['hash']
+        and entry['file'] == relative_file_path
+        and os.path.exists(os.path.join(root_output_directory, relative_file_path))
+    )
+
+def record_manifest_entry(root_output_directory, source, relative_file_path, doc_number, offset=None, length=None):
+    manifest = current_manifests.setdefault(root_output_directory, {'operations': {}})
+    entry = {
+        'hash': source['hash'],
+        'file': relative_file_path,
+        'doc_number': doc_number
+    }
+    if offset is not None:
+        entry['offset'] = offset
+        entry['length'] = length
+    manifest['operations'][source['key']] = entry
+
+def save_manifests():
+    # Removes files of endpoints that were deleted or renumbered, then writes the manifests for the next run
+    for root_output_directory, manifest in current_manifests.items():
+        current_files = {entry['file'] for entry in manifest['operations'].values()}
+        for entry in load_manifest(root_output_directory)['operations'].values():
+            if entry['file'] not in current_files:
+                stale_file_path = os.path.join(root_output_directory, entry['file'])
+                if os.path.exists(stale_file_path):
+                    os.remove(stale_file_path)
+        with open(os.path.join(root_output_directory, manifest_file_name), 'w') as file:
+            file.write(json_dumps(manifest))
+    previous_manifests.clear()
+    current_manifests.clear()
+
+# The cache size is fixed here, at import time, see sanitizer_cache_size
+@lru_cache(maxsize=sanitizer_cache_size)
+def remove_html_tags_and_punctuation(input_str):
+    # Keys and many values repeat across endpoints, so results are cached
+    # Strip HTML tags
+    if '<' in input_str:
+        input_str = html_tag_pattern.sub('', input_str)
+    # Remove punctuation characters
+    return input_str.translate(punctuation_table).strip()
+
 def write_dict_to_text(data):
-    def remove_html_tags_and_punctuation(input_str):
-        # Strip HTML tags
-        no_html_str = re.sub('<.*?>', '', input_str)
-        # Define the characters that should be considered as punctuation
-        modified_punctuation = set(string.punctuation) - {'/', '#'}
-        # Remove punctuation characters
-        return ''.join(ch for ch in no_html_str if ch not in modified_punctuation).strip()
-    
-    # List to accumulate the formatted text parts
-    formatted_text_parts = []
-    
-    # Check if data is a dictionary
-    if isinstance(data, dict):
-        # Iterate over items in the dictionary
-        for key, value in data.items():
+    # Join the formatted text parts with a single newline character
+    return '\n'.join(iter_text_lines(data))
+
+def write_dict_to_stream(data, writer):
+    # Writes the same text as write_dict_to_text to a file-like writer, one line at a time
+    for line_number, line in enumerate(iter_text_lines(data)):
+        if line_number:
+            writer.write('\n')
+        writer.write(line)
+
+def iter_text_lines(data):
+    # Yields the non empty lines of write_dict_to_text in order. Walks with an explicit stack instead of recursion
+    # so deeply nested schemas can't hit the recursion limit, and nothing is joined until the caller wants it
+    end_of_items = object()
+    # (is_dict, iterator over the remaining items) for every dict or list being written
+    stack = [(False, iter((data,)))]
+    while stack:
+        is_dict, items = stack[-1]
+        item = next(items, end_of_items)
+        if item is end_of_items:
+            stack.pop()
+            continue
+
+        if is_dict:
+            key, value = item
             # Remove HTML tags and punctuation from key
             key = remove_html_tags_and_punctuation(key)
-            
-            # Depending on the data type, write the content
             if isinstance(value, (dict, list)):
-                # Append the key followed by its sub-elements
-                formatted_text_parts.append(key)
-                formatted_text_parts.append(write_dict_to_text(value))
+                # The key followed by its sub-elements
+                if key:
+                    yield key
             else:
                 # Remove HTML tags and punctuation from value
                 value = remove_html_tags_and_punctuation(str(value))
-                # Append the key-value pair
-                formatted_text_parts.append(f"{key} {value}")
-    # Check if data is a list
-    elif isinstance(data, list):
-        # Append each element in the list
-        for item in data:
-            formatted_text_parts.append(write_dict_to_text(item))
-    # If data is a string or other type
-    else:
-        # Remove HTML tags and punctuation from data
-        data = remove_html_tags_and_punctuation(str(data))
-        # Append the data directly
-        formatted_text_parts.append(data)
-    
-    # Join the formatted text parts with a single newline character
-    # but filter out any empty strings before joining
-    return '\n'.join(filter(lambda x: x.strip(), formatted_text_parts))
+                if key or value:
+                    yield f"{key} {value}"
+                continue
+        else:
+            value = item
+
+        if isinstance(value, dict):
+            stack.append((True, iter(value.items())))
+        elif isinstance(value, list):
+            stack.append((False, iter(value)))
+        else:
+            # Remove HTML tags and punctuation from data
+            value = remove_html_tags_and_punctuation(str(value))
+            if value:
+                yield value
 
 def create_key_point_guide(endpoints_by_tag_metadata, tag_summary_dict, root_output_directory):
     # Ensure output directory exists
@@ -463,6 +1806,25 @@ def create_key_point_guide(endpoints_by_tag_metadata, tag_summary_dict, root_out
     # Define output file path
     output_file_path = os.path.join(root_output_directory, 'LLM_OAS_keypoint_guide_file.txt')
 
+    if guide_mode == 'tiered':
+        output_string, group_strings = tiered_guide_texts(endpoints_by_tag_metadata, tag_summary_dict)
+        for group, group_string in enumerate(group_strings):
+            with open(os.path.join(root_output_directory, guide_group_file_name.format(group=group)), 'w') as output_file:
+                output_file.write(group_string)
+        # Group files left by an earlier run with more groups
+        group = len(group_strings)
+        while os.path.exists(os.path.join(root_output_directory, guide_group_file_name.format(group=group))):
+            os.remove(os.path.join(root_output_directory, guide_group_file_name.format(group=group)))
+            group += 1
+    else:
+        output_string = key_point_guide_text(endpoints_by_tag_metadata, tag_summary_dict)
+
+    print(f'keypoint file token count: {tiktoken_len(output_string)}')
+    # Write sorted info_strings to the output file
+    with open(output_file_path, 'w') as output_file:
+            output_file.write(output_string)
+
+def key_point_guide_text(endpoints_by_tag_metadata, tag_summary_dict):
     output_string = ''
 
     # Now, iterate over each unique tag
@@ -488,28 +1850,466 @@ def create_key_point_guide(endpoints_by_tag_metadata, tag_summary_dict, root_out
 
         output_string += f'{tag_string}\n'
 
-    print(f'keypoint file token count: {tiktoken_len(output_string)}')
-    # Write sorted info_strings to the output file
-    with open(output_file_path, 'w') as output_file:
-            output_file.write(output_string)
+    return output_string
+
+def tiered_guide_texts(endpoints_by_tag_metadata, tag_summary_dict):
+    # Top level of a tiered guide, one line per tag. Descriptions are cut to the most words per tag that keep it
+    # within guide_token_budget. If even the bare tag names don't fit, the bare names are packed into groups that each
+    # fit, a group keeps as many description words as it has room for, and the top level lists the groups. A listing
+    # still over the budget is grouped again until it fits. Returns the top level and the group texts, which are
+    # written as their own files
+    tag_descriptions = []
+    for tag in endpoints_by_tag_metadata:
+        tag_description = tag_summary_dict.get(tag)
+        if keys_to_keep["tag_descriptions"] and tag_description:
+            tag_descriptions.append((tag, write_dict_to_text(tag_description).split()))
+        else:
+            tag_descriptions.append((tag, []))
+
+    def tag_lines(descriptions, max_words):
+        return [
+            f'{tag}! {" ".join(words[:max_words])}!!\n' if words and max_words else f'{tag}!\n'
+            for tag, words in descriptions
+        ]
+
+    def fits(lines):
+        return sum(tiktoken_len_batch(lines)) <= guide_token_budget
+
+    def described_tag_lines(descriptions):
+        # Largest number of description words that still fits, the bare tag names if none do
+        low, high = 0, max((len(words) for tag, words in descriptions), default=0)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if fits(tag_lines(descriptions, middle)):
+                low = middle
+            else:
+                high = middle - 1
+        return tag_lines(descriptions, low)
+
+    def group_lines(lines):
+        # Consecutive lines in groups that fit the budget. If every line is over the budget on its own they go in
+        # pairs, so each round of grouping shortens the listing
+        groups = []
+        group_token_count = 0
+        for index, token_count in enumerate(tiktoken_len_batch(lines)):
+            if not groups or group_token_count + token_count > guide_token_budget:
+                groups.append([])
+                group_token_count = 0
+            groups[-1].append(index)
+            group_token_count += token_count
+        if len(groups) == len(lines):
+            groups = [list(range(index, min(index + 2, len(lines)))) for index in range(0, len(lines), 2)]
+        return groups
+
+    lines = described_tag_lines(tag_descriptions)
+    if fits(lines):
+        return ''.join(lines), []
+
+    group_texts = []
+    # First and last tag covered by each line of the listing
+    tag_ranges = [(tag, tag) for tag, words in tag_descriptions]
+    lines = tag_lines(tag_descriptions, 0)
+    listing_tags = True
+    while len(lines) > 1 and not fits(lines):
+        listing_tag_ranges = []
+        listing_lines = []
+        for group in group_lines(lines):
+            first_tag, last_tag = tag_ranges[group[0]][0], tag_ranges[group[-1]][1]
+            listing_tag_ranges.append((first_tag, last_tag))
+            listing_lines.append(f'{first_tag} to {last_tag}! see group {len(group_texts)}!!\n')
+            if listing_tags:
+                group_texts.append(''.join(described_tag_lines([tag_descriptions[index] for index in group])))
+            else:
+                group_texts.append(''.join(lines[index] for index in group))
+        tag_ranges, lines = listing_tag_ranges, listing_lines
+        listing_tags = False
+    return ''.join(lines), group_texts
+
+def tag_guide_text(root_output_directory, tag, page=0):
+    # Second tier of a tiered guide, the operations of one tag in the same format as the flat guide.
+    # Tags with more operations than fit guide_token_budget are split into pages, returns the page and the page count
+    documents = sorted(lookup_guide_index(root_output_directory, 'tag', tag), key=lambda document: document['doc_number'])
+    entries = [f"{document['operation_id']}-{document['doc_number']}!" for document in documents]
+    heading = f'{tag}!\n'
+    budget = guide_token_budget - tiktoken_len(heading)
+    pages = [[]]
+    page_token_count = 0
+    for entry, token_count in zip(entries, tiktoken_len_batch(entries)):
+        if pages[-1] and page_token_count + token_count > budget:
+            pages.append([])
+            page_token_count = 0
+        pages[-1].append(entry)
+        page_token_count += token_count
+    if not 0 <= page < len(pages):
+        raise IndexError(f"Tag {tag} has {len(pages)} pages")
+    return heading + ''.join(pages[page]) + '\n', len(pages)
+
+def guide_source(source):
+    # What the guide index needs to know about a written endpoint besides its metadata
+    return {'path': source['path'], 'method': source['method'], 'location': source.get('location')}
+
+def create_guide_index(endpoints_by_tag_metadata, root_output_directory):
+    # Layout: header, one open addressing hash table per key in guide_index_keys, postings (record numbers of each
+    # key, grouped by key), records, strings. Strings are a 4 byte length and utf-8 bytes, stored once each
+    strings = bytearray()
+    string_offsets = {}
+
+    def add_string(value):
+        value = '' if value is None else str(value)
+        if value not in string_offsets:
+            string_offsets[value] = len(strings)
+            encoded = value.encode('utf-8')
+            strings.extend(struct.pack('<I', len(encoded)))
+            strings.extend(encoded)
+        return string_offsets[value]
+
+    records = bytearray()
+    record_numbers_by_key = {key: defaultdict(list) for key in guide_index_keys}
+    record_count = 0
+    for tag, endpoints_with_tag in endpoints_by_tag_metadata.items():
+        for endpoint in endpoints_with_tag:
+            metadata = endpoint['metadata']
+            source = endpoint['source']
+            file_path, offset, length = source['location'] or ['', 0, 0]
+            records.extend(guide_index_record.pack(
+                metadata['doc_number'], offset, length,
+                add_string(file_path), add_string(metadata['tag']), add_string(metadata['operation_id']),
+                add_string(source['path']), add_string(source['method'])
+            ))
+            for key, value in zip(guide_index_keys, (metadata['operation_id'], metadata['doc_number'], metadata['tag'], source['path'])):
+                record_numbers_by_key[key][str(value)].append(record_count)
+            record_count += 1
+
+    # Power of two with at most half the slots used, so probes stay short
+    table_size = 8
+    while table_size < 2 * max(len(record_numbers) for record_numbers in record_numbers_by_key.values()):
+        table_size *= 2
+
+    tables = bytearray()
+    postings = []
+    for key in guide_index_keys:
+        slots = [None] * table_size
+        for value, record_numbers in record_numbers_by_key[key].items():
+            value_hash = guide_index_hash(value)
+            slot = value_hash & (table_size - 1)
+            while slots[slot] is not None:
+                slot = (slot + 1) & (table_size - 1)
+            slots[slot] = (value_hash, add_string(value), len(postings), len(record_numbers))
+            postings.extend(record_numbers)
+        for slot in slots:
+            tables.extend(guide_index_slot.pack(*(slot or (0, 0, 0, 0))))
+
+    index_path = os.path.join(root_output_directory, guide_index_file_name)
+    # Replaced in one rename, lookups that already mapped the previous index keep reading it
+    with open(f'{index_path}.tmp', 'wb') as file:
+        file.write(guide_index_header.pack(guide_index_magic, record_count, table_size, len(postings), len(strings)))
+        file.write(tables)
+        file.write(struct.pack(f'<{len(postings)}I', *postings))
+        file.write(records)
+        file.write(strings)
+    os.replace(f'{index_path}.tmp', index_path)
+    previous_index = guide_indexes.pop(root_output_directory, None)
+    if previous_index is not None:
+        previous_index.close()
+
+def guide_index_hash(value):
+    # Stable between processes, unlike hash()
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'little')
+
+def lookup_guide_index(root_output_directory, key, value):
+    # Documents whose key (one of guide_index_keys) equals value, as dicts with the doc_number, tag, operation_id,
+    # path, method and the file, offset and length to read it from. An empty list if there are none
+    index = guide_indexes.get(root_output_directory)
+    if index is None:
+        with open(os.path.join(root_output_directory, guide_index_file_name), 'rb') as file:
+            index = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if index[:len(guide_index_magic)] != guide_index_magic:
+            raise ValueError(f"Not a keypoint guide index: {root_output_directory}")
+        guide_indexes[root_output_directory] = index
+
+    _, record_count, table_size, posting_count, _ = guide_index_header.unpack_from(index, 0)
+    tables_offset = guide_index_header.size
+    postings_offset = tables_offset + len(guide_index_keys) * table_size * guide_index_slot.size
+    records_offset = postings_offset + posting_count * 4
+    strings_offset = records_offset + record_count * guide_index_record.size
+
+    def read_string(string_offset):
+        start = strings_offset + string_offset
+        length, = struct.unpack_from('<I', index, start)
+        return index[start + 4:start + 4 + length].decode('utf-8')
+
+    value = str(value)
+    value_hash = guide_index_hash(value)
+    table_offset = tables_offset + guide_index_keys.index(key) * table_size * guide_index_slot.size
+    slot = value_hash & (table_size - 1)
+    while True:
+        slot_hash, key_string, first_posting, posting_count = guide_index_slot.unpack_from(
+            index, table_offset + slot * guide_index_slot.size
+        )
+        if posting_count == 0:
+            return []
+        if slot_hash == value_hash and read_string(key_string) == value:
+            break
+        slot = (slot + 1) & (table_size - 1)
+
+    documents = []
+    for posting in range(first_posting, first_posting + posting_count):
+        record_number, = struct.unpack_from('<I', index, postings_offset + posting * 4)
+        doc_number, offset, length, file_path, tag, operation_id, path, method = guide_index_record.unpack_from(
+            index, records_offset + record_number * guide_index_record.size
+        )
+        documents.append({
+            'doc_number': doc_number,
+            'tag': read_string(tag),
+            'operation_id': read_string(operation_id),
+            'path': read_string(path),
+            'method': read_string(method) or None,
+            'file': read_string(file_path),
+            'offset': offset,
+            'length': length
+        })
+    return documents
+
+def read_guide_index_document(root_output_directory, document):
+    # Reads a document found by lookup_guide_index
+    with open(os.path.join(root_output_directory, document['file']), 'rb') as file:
+        file.seek(document['offset'])
+        return json_loads(file.read(document['length']) if document['length'] else file.read())
+
+def close_guide_indexes():
+    # Call to pick up indexes rewritten by a later run
+    for index in guide_indexes.values():
+        index.close()
+    guide_indexes.clear()
+
+def collect_stage_counts(endpoints_by_tag_metadata, root_output_directory):
+    for tag, endpoints_with_tag in endpoints_by_tag_metadata.items():
+        for endpoint in endpoints_with_tag:
+            stage_counts = endpoint['source'].get('stages')
+            if stage_counts:
+                stage_report_endpoints[root_output_directory].append({
+                    'tag': tag,
+                    'operation_id': endpoint['metadata']['operation_id'],
+                    'stages': stage_counts
+                })
+
+def write_stage_reports():
+    for root_output_directory, measured_endpoints in stage_report_endpoints.items():
+        by_stage = {stage: {'bytes': 0, 'tokens': 0} for stage in stage_names}
+        by_tag = {}
+        for measured_endpoint in measured_endpoints:
+            tag_totals = by_tag.setdefault(measured_endpoint['tag'], {stage: {'bytes': 0, 'tokens': 0} for stage in stage_names})
+            for stage, counts in measured_endpoint['stages'].items():
+                for totals in (by_stage[stage], tag_totals[stage]):
+                    totals['bytes'] += counts['bytes']
+                    totals['tokens'] += counts['tokens']
+
+        # What each stage saved compared to the one before it
+        for previous_stage, stage in zip(stage_names, stage_names[1:]):
+            by_stage[stage]['saved_tokens'] = by_stage[previous_stage]['tokens'] - by_stage[stage]['tokens']
+            by_stage[stage]['saved_bytes'] = by_stage[previous_stage]['bytes'] - by_stage[stage]['bytes']
+
+        os.makedirs(root_output_directory, exist_ok=True)
+        report_path = os.path.join(root_output_directory, stage_report_file_name)
+        if stage_report_file_name.endswith('.csv'):
+            with open(report_path, 'w', newline='') as file:
+                writer = csv.writer(file)
+                writer.writerow(['scope', 'tag', 'operation_id', 'stage', 'bytes', 'tokens'])
+                for stage in stage_names:
+                    writer.writerow(['total', '', '', stage, by_stage[stage]['bytes'], by_stage[stage]['tokens']])
+                for tag, tag_totals in sorted(by_tag.items()):
+                    for stage in stage_names:
+                        writer.writerow(['tag', tag, '', stage, tag_totals[stage]['bytes'], tag_totals[stage]['tokens']])
+                for measured_endpoint in measured_endpoints:
+                    for stage, counts in measured_endpoint['stages'].items():
+                        writer.writerow(['endpoint', measured_endpoint['tag'], measured_endpoint['operation_id'], stage, counts['bytes'], counts['tokens']])
+        else:
+            with open(report_path, 'w') as file:
+                file.write(json.dumps({
+                    'stages': stage_names,
+                    'by_stage': by_stage,
+                    'by_tag': by_tag,
+                    'endpoints': measured_endpoints
+                }, indent=2))
+
+        print(f'stage report: {report_path}')
+        for stage in stage_names:
+            print(f"  {stage}: {by_stage[stage]['tokens']} tokens")
+    stage_report_endpoints.clear()
+
+def search_terms(text):
+    return search_term_pattern.findall(text.lower())
+
+def collect_search_terms(endpoints_by_tag_metadata, root_output_directory):
+    # Call after create_endpoint_files, documents are indexed by doc_number
+    for tag, endpoints_with_tag in endpoints_by_tag_metadata.items():
+        for endpoint in endpoints_with_tag:
+            search_index_documents[root_output_directory].append(
+                (endpoint['metadata']['doc_number'], Counter(search_terms(endpoint['content'])))
+            )
+
+def write_search_indexes():
+    # postings maps each term to [doc_number, term count] pairs, lengths maps each doc_number to its number of terms
+    for root_output_directory, documents in search_index_documents.items():
+        postings = defaultdict(list)
+        lengths = {}
+        for doc_number, term_counts in documents:
+            lengths[doc_number] = sum(term_counts.values())
+            for term, term_count in term_counts.items():
+                postings[term].append([doc_number, term_count])
+        search_index = {
+            'document_count': len(lengths),
+            'average_length': sum(lengths.values()) / len(lengths) if lengths else 0,
+            'lengths': lengths,
+            'postings': dict(sorted(postings.items()))
+        }
+        os.makedirs(root_output_directory, exist_ok=True)
+        with open(os.path.join(root_output_directory, search_index_file_name), 'w') as file:
+            file.write(json_dumps(search_index))
+        search_indexes.pop(root_output_directory, None)
+    search_index_documents.clear()
+
+def search_endpoints(root_output_directory, query, k=10):
+    # The k documents of an output directory that best match query by BM25, as (doc_number, score), best first
+    search_index = search_indexes.get(root_output_directory)
+    if search_index is None:
+        with open(os.path.join(root_output_directory, search_index_file_name), 'rb') as file:
+            search_index = json_loads(file.read())
+        search_index['lengths'] = {int(doc_number): length for doc_number, length in search_index['lengths'].items()}
+        search_indexes[root_output_directory] = search_index
+
+    document_count = search_index['document_count']
+    average_length = search_index['average_length'] or 1
+    lengths = search_index['lengths']
+    scores = defaultdict(float)
+    for term in set(search_terms(query)):
+        term_postings = search_index['postings'].get(term)
+        if not term_postings:
+            continue
+        inverse_document_frequency = math.log(1 + (document_count - len(term_postings) + 0.5) / (len(term_postings) + 0.5))
+        for doc_number, term_count in term_postings:
+            length_norm = search_bm25_k1 * (1 - search_bm25_b + search_bm25_b * lengths[doc_number] / average_length)
+            scores[doc_number] += inverse_document_frequency * term_count * (search_bm25_k1 + 1) / (term_count + length_norm)
+    return heapq.nlargest(k, scores.items(), key=lambda item: (item[1], -item[0]))
+
+def collect_export_rows(endpoints_by_tag_metadata, root_output_directory):
+    # Call after create_endpoint_files. Full batches are written right away, the rest by write_export_batches
+    for tag, endpoints_with_tag in endpoints_by_tag_metadata.items():
+        contents = [endpoint['content'] for endpoint in endpoints_with_tag]
+        for endpoint, token_count in zip(endpoints_with_tag, tiktoken_len_batch(contents)):
+            metadata = endpoint['metadata']
+            source = endpoint['source']
+            export_rows[root_output_directory].append({
+                'id': hashlib.blake2b(source['key'].encode('utf-8'), digest_size=16).hexdigest(),
+                'content_hash': hashlib.blake2b(endpoint['content'].encode('utf-8'), digest_size=16).hexdigest(),
+                'doc_number': metadata['doc_number'],
+                'tag': metadata['tag'],
+                'operation_id': metadata['operation_id'],
+                'method': source['method'] or '',
+                'path': source['path'],
+                'server_url': metadata['server_url'],
+                'doc_url': metadata['doc_url'],
+                'token_count': token_count,
+                'text': endpoint['content']
+            })
+            if len(export_rows[root_output_directory]) >= export_batch_size:
+                write_export_batch(root_output_directory)
+
+def write_export_batches():
+    for root_output_directory in list(export_rows):
+        if export_rows[root_output_directory] or root_output_directory not in export_batch_counts:
+            write_export_batch(root_output_directory)
+    export_rows.clear()
+    export_batch_counts.clear()
+
+def write_export_batch(root_output_directory):
+    export_directory = os.path.join(root_output_directory, export_directory_name)
+    if root_output_directory not in export_batch_counts:
+        # Batches of an earlier run would be mixed in with this one's
+        if os.path.exists(export_directory):
+            shutil.rmtree(export_directory)
+        os.makedirs(export_directory)
+        export_batch_counts[root_output_directory] = 0
+
+    rows = export_rows[root_output_directory]
+    columns = {column: [row[column] for row in rows] for column in export_columns}
+    batch_path = os.path.join(export_directory, f'batch-{export_batch_counts[root_output_directory]:05d}')
+    file_format = get_export_format()
+    if file_format == 'parquet':
+        pyarrow.parquet.write_table(pyarrow.table(columns), f'{batch_path}.parquet')
+    elif file_format == 'npz':
+        # Fixed width string arrays would pad every value to the longest text, and object arrays need allow_pickle
+        # to load, so text is stored as concatenated UTF-8 bytes and offsets
+        arrays = {}
+        for column, values in columns.items():
+            if column in ('doc_number', 'token_count'):
+                arrays[column] = numpy.array(values, dtype=numpy.int64)
+                continue
+            encoded_values = [value.encode('utf-8') for value in values]
+            arrays[f'{column}_bytes'] = numpy.frombuffer(b''.join(encoded_values), dtype=numpy.uint8)
+            arrays[f'{column}_offsets'] = numpy.cumsum([0] + [len(value) for value in encoded_values], dtype=numpy.int64)
+        numpy.savez(f'{batch_path}.npz', **arrays)
+    else:
+        with open(f'{batch_path}.json', 'w') as file:
+            file.write(json_dumps(columns))
+    export_batch_counts[root_output_directory] += 1
+    rows.clear()
+
+def get_export_format():
+    if export_format != 'auto':
+        if export_format == 'parquet' and pyarrow is None:
+            raise ValueError("export_format 'parquet' needs pyarrow")
+        if export_format == 'npz' and numpy is None:
+            raise ValueError("export_format 'npz' needs numpy")
+        if export_format not in ('parquet', 'npz', 'json'):
+            raise ValueError(f"Unsupported export format: {export_format}")
+        return export_format
+    if pyarrow is not None:
+        return 'parquet'
+    if numpy is not None:
+        return 'npz'
+    return 'json'
 
 def count_tokens_in_directory(directory):
     token_counts = []
     max_tokens = 0
     max_file = ''
-    
-    for dirpath, dirnames, filenames in os.walk(directory):
+
+    # Read everything first so the contents can be tokenized in one batch
+    filepaths = []
+    contents = []
+    # Staged output directories are symlinks to their current version, the other versions aren't counted
+    for dirpath, dirnames, filenames in os.walk(directory, followlinks=True):
+        if staged_versions_directory_name in dirnames:
+            dirnames.remove(staged_versions_directory_name)
+        if export_directory_name in dirnames:
+            dirnames.remove(export_directory_name)
+        # Chunks repeat the content of the endpoint documents
+        if balanced_chunks_directory_name in dirnames:
+            dirnames.remove(balanced_chunks_directory_name)
         for filename in filenames:
-            if filename.endswith('.json'):
+            if filename.endswith('.json') and filename not in (
+                manifest_file_name, archive_index_file_name, stage_report_file_name, search_index_file_name, doc_number_map_file_name
+            ):
                 filepath = os.path.join(dirpath, filename)
-                with open(filepath, 'r') as file:
-                    file_content = json.load(file)
-                    content = file_content.get("content", "")
-                    token_count = tiktoken_len(content)
-                    token_counts.append(token_count)
-                    if token_count > max_tokens:
-                        max_tokens = token_count
-                        max_file = filepath
+                with open(filepath, 'rb') as file:
+                    file_content = json_loads(file.read())
+                    filepaths.append(filepath)
+                    contents.append(file_content.get("content", ""))
+            elif filename.endswith('.jsonl'):
+                # Archives hold one document per line
+                filepath = os.path.join(dirpath, filename)
+                with open(filepath, 'rb') as file:
+                    for line_number, line in enumerate(file):
+                        file_content = json_loads(line)
+                        filepaths.append(f'{filepath}:{line_number}')
+                        contents.append(file_content.get("content", ""))
+
+    for filepath, token_count in zip(filepaths, tiktoken_len_batch(contents)):
+        token_counts.append(token_count)
+        if token_count > max_tokens:
+            max_tokens = token_count
+            max_file = filepath
 
     print("Total files:", len(token_counts))
     if not token_counts:
@@ -522,12 +2322,103 @@ def count_tokens_in_directory(directory):
     return token_counts
 
 def tiktoken_len(text):
-    tokens = tokenizer.encode(
-        text,
+    # Loads the tokenizer first, so counts cached with other tokenizer settings are dropped before they're looked up
+    get_tokenizer()
+    key = token_count_key(text)
+    token_count = token_count_cache.get(key)
+    if token_count is None:
+        token_count = count_tokens([text])[0]
+        token_count_cache[key] = token_count
+    return token_count
+
+def tiktoken_len_batch(texts):
+    # Token counts for many texts, only the ones not counted before this run are sent to the tokenizer
+    get_tokenizer()
+    keys = [token_count_key(text) for text in texts]
+    uncounted = {}
+    for key, text in zip(keys, texts):
+        if key not in token_count_cache:
+            uncounted[key] = text
+    if uncounted:
+        for key, token_count in zip(uncounted, count_tokens(list(uncounted.values()))):
+            token_count_cache[key] = token_count
+    return [token_count_cache[key] for key in keys]
+
+def count_tokens(texts):
+    # Uncached token counts from whichever backend is configured
+    counter = get_tokenizer()
+    if not hasattr(counter, 'encode_batch'):
+        return [counter(text) for text in texts]
+    if len(texts) == 1:
+        return [len(counter.encode(texts[0], disallowed_special=()))]
+    encoded_texts = counter.encode_batch(
+        texts,
+        num_threads=token_count_threads,
         disallowed_special=()
     )
-    return len(tokens)
+    return [len(tokens) for tokens in encoded_texts]
+
+def get_tokenizer():
+    # Loaded again whenever a tokenizer setting changed since the last load, for example after a Minifier run put
+    # the module settings back
+    global tokenizer, loaded_tokenizer_settings
+    if tokenizer is None or loaded_tokenizer_settings != current_tokenizer_settings():
+        reset_tokenizer()
+        tokenizer = load_tokenizer(tokenizer_backend)
+        loaded_tokenizer_settings = current_tokenizer_settings()
+    return tokenizer
+
+def current_tokenizer_settings():
+    module_globals = globals()
+    return [module_globals[name] for name in tokenizer_settings]
+
+def load_tokenizer(backend):
+    if callable(backend):
+        return backend
+    if backend == 'approximate':
+        return approximate_token_count
+    if backend == 'tiktoken':
+        import tiktoken
+        return tiktoken.encoding_for_model(tokenizer_model)
+    if backend == 'bpe_file':
+        return load_bpe_file_encoding(tokenizer_bpe_file)
+    raise ValueError(f"Unsupported tokenizer backend: {backend}")
+
+def load_bpe_file_encoding(bpe_file):
+    import tiktoken
+    from tiktoken.load import load_tiktoken_bpe
+
+    if bpe_file is None:
+        raise ValueError("tokenizer_bpe_file must be set to use the 'bpe_file' tokenizer backend")
+    # Same split pattern and special tokens as cl100k_base, the encoding behind text-embedding-ada-002
+    return tiktoken.Encoding(
+        name=os.path.basename(bpe_file),
+        pat_str=r"""(?i:'s|'t|'re|'ve|'m|'ll|'d)|[^\r\n\p{L}\p{N}]?\p{L}+|\p{N}{1,3}| ?[^\s\p{L}\p{N}]+[\r\n]*|\s*[\r\n]+|\s+(?!\S)|\s+""",
+        mergeable_ranks=load_tiktoken_bpe(bpe_file),
+        special_tokens={
+            "<|endoftext|>": 100257,
+            "<|fim_prefix|>": 100258,
+            "<|fim_middle|>": 100259,
+            "<|fim_suffix|>": 100260,
+            "<|endofprompt|>": 100276,
+        }
+    )
+
+def approximate_token_count(text):
+    return math.ceil(len(text) / approximate_chars_per_token)
+
+def reset_tokenizer():
+    # Drops the loaded tokenizer and the counts cached with it, get_tokenizer calls this when a tokenizer setting changed
+    global tokenizer, loaded_tokenizer_settings
+    tokenizer = None
+    loaded_tokenizer_settings = None
+    token_count_cache.clear()
+
+def token_count_key(text):
+    # Keyed by a digest rather than the text itself so the cache stays small
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
 
-main()
+if __name__ == '__main__':
+    main()
 
     
@@ -0,0 +1,220 @@
+"""Keeps a Minifier loaded and serves minified specs over HTTP, so each spec only costs the minification itself.
+
+    python minifier_server.py --port 8080 --watch input_openAPI_specs/stackpath
+    python minifier_server.py --unix /tmp/minifier.sock --settings settings.json
+
+    POST /minify                       a JSON or YAML spec in the body, returns its documents and keypoint guide
+    GET  /specs                        the watched spec files
+    GET  /specs/{file}/guide           keypoint guide of a watched spec, as text
+    GET  /specs/{file}/docs/{number}   one document of a watched spec
+"""
+import argparse
+import asyncio
+import os
+from http import HTTPStatus
+from urllib.parse import unquote, urlsplit
+
+import yaml
+
+import minifier
+
+host = '127.0.0.1'
+port = 8080
+# Serve on this Unix socket instead of host and port when set
+unix_socket_path = None
+# Directory of specs kept minified in memory, checked for new, changed and removed files every watch_interval seconds
+watch_directory = None
+watch_interval = 5.0
+# Also write the output files of the watched specs like the script does, whenever one changes
+watch_writes_output = False
+# Largest request body accepted
+max_body_bytes = 64 * 1024 * 1024
+
+# Minified watched specs by file name, {'mtime', 'size', 'documents', 'documents_by_number', 'guide'}
+watched_specs = {}
+
+def parse_spec(body):
+    # JSON is tried first since it's much faster to parse, YAML covers everything else
+    try:
+        return minifier.json_loads(body)
+    except ValueError:
+        return yaml.safe_load(body)
+
+async def minify_documents(spec_minifier, openapi_spec):
+    # Minification is CPU bound, it runs in a thread so requests for already minified specs are still answered
+    return await asyncio.to_thread(spec_minifier.documents, openapi_spec)
+
+async def refresh_watched_specs(spec_minifier):
+    current_files = {}
+    for filename in sorted(os.listdir(watch_directory)):
+        if filename.endswith(('.json', '.yaml')):
+            file_stat = os.stat(os.path.join(watch_directory, filename))
+            current_files[filename] = (file_stat.st_mtime_ns, file_stat.st_size)
+
+    for filename in list(watched_specs):
+        if filename not in current_files:
+            print(f'removed {filename}')
+            del watched_specs[filename]
+
+    changed_specs = []
+    for filename, (mtime, size) in current_files.items():
+        spec = watched_specs.get(filename)
+        if spec is not None and spec['mtime'] == mtime and spec['size'] == size:
+            continue
+        try:
+            openapi_spec = await asyncio.to_thread(minifier.load_file, os.path.join(watch_directory, filename))
+            documents, guide = await minify_documents(spec_minifier, openapi_spec)
+        except Exception as error:
+            # A half written or broken file is retried once it changes again
+            print(f'failed to minify {filename}: {error}')
+            watched_specs[filename] = {
+                'mtime': mtime, 'size': size, 'documents': [], 'documents_by_number': {}, 'guide': '', 'error': str(error)
+            }
+            continue
+        # Stable doc numbers have gaps, so documents are looked up by their number rather than their position
+        documents_by_number = {document['metadata']['doc_number']: document for document in documents}
+        watched_specs[filename] = {
+            'mtime': mtime, 'size': size, 'documents': documents, 'documents_by_number': documents_by_number, 'guide': guide
+        }
+        changed_specs.append(openapi_spec)
+        print(f'minified {filename}: {len(documents)} documents')
+
+    if changed_specs and watch_writes_output:
+        # Output directories hold every spec with the same server, so all of them are written again
+        await asyncio.to_thread(spec_minifier.run)
+
+async def watch_specs(spec_minifier):
+    while True:
+        try:
+            await refresh_watched_specs(spec_minifier)
+        except Exception as error:
+            # Writing the output can fail on a file that doesn't belong there, the watcher keeps going regardless
+            print(f'failed to refresh {watch_directory}: {error!r}')
+        await asyncio.sleep(watch_interval)
+
+async def handle_request(method, path, body, spec_minifier):
+    # Returns the status, content type and body of the response
+    parts = [unquote(part) for part in urlsplit(path).path.split('/') if part]
+
+    if method == 'POST' and parts == ['minify']:
+        try:
+            # Parsing a large YAML spec takes long enough to hold up every other request, so it runs in a thread too
+            openapi_spec = await asyncio.to_thread(parse_spec, body)
+        except yaml.YAMLError as error:
+            return error_response(HTTPStatus.BAD_REQUEST, f'invalid spec: {error}')
+        if not isinstance(openapi_spec, dict) or 'paths' not in openapi_spec:
+            return error_response(HTTPStatus.BAD_REQUEST, 'invalid spec: no paths')
+        try:
+            documents, guide = await minify_documents(spec_minifier, openapi_spec)
+        except Exception as error:
+            # Any spec that parses but doesn't have the shape minify expects ends up here
+            return error_response(HTTPStatus.UNPROCESSABLE_ENTITY, f'failed to minify: {error!r}')
+        return json_response({'documents': documents, 'guide': guide})
+
+    if method == 'GET' and parts == ['specs']:
+        return json_response({
+            filename: {'documents': len(spec['documents']), 'error': spec.get('error')}
+            for filename, spec in watched_specs.items()
+        })
+
+    if method == 'GET' and len(parts) >= 3 and parts[0] == 'specs':
+        spec = watched_specs.get(parts[1])
+        if spec is None:
+            return error_response(HTTPStatus.NOT_FOUND, f'unknown spec: {parts[1]}')
+        if parts[2:] == ['guide']:
+            return HTTPStatus.OK, 'text/plain; charset=utf-8', spec['guide'].encode('utf-8')
+        if len(parts) == 4 and parts[2] == 'docs' and parts[3].isdigit() and int(parts[3]) in spec['documents_by_number']:
+            return json_response(spec['documents_by_number'][int(parts[3])])
+        return error_response(HTTPStatus.NOT_FOUND, 'unknown document')
+
+    return error_response(HTTPStatus.NOT_FOUND, f'no route for {method} {path}')
+
+def json_response(data, status=HTTPStatus.OK):
+    return status, 'application/json', minifier.json_dumps(data).encode('utf-8')
+
+def error_response(status, message):
+    return json_response({'error': message}, status)
+
+async def serve_connection(reader, writer, spec_minifier):
+    # One request per connection, enough for a gateway calling in now and then
+    try:
+        request_line = (await reader.readline()).decode('latin-1').split()
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if len(request_line) != 3:
+            status, content_type, body = error_response(HTTPStatus.BAD_REQUEST, 'malformed request line')
+        else:
+            method, path, _ = request_line
+            content_length = headers.get('content-length', '0') or '0'
+            content_length = int(content_length) if content_length.isdigit() else None
+            if content_length is None:
+                status, content_type, body = error_response(HTTPStatus.BAD_REQUEST, 'invalid Content-Length')
+            elif content_length > max_body_bytes:
+                status, content_type, body = error_response(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, 'spec too large')
+            else:
+                request_body = await reader.readexactly(content_length) if content_length else b''
+                status, content_type, body = await handle_request(method.upper(), path, request_body, spec_minifier)
+
+        writer.write(
+            f'HTTP/1.1 {status.value} {status.phrase}\r\n'
+            f'Content-Type: {content_type}\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            'Connection: close\r\n\r\n'.encode('latin-1') + body
+        )
+        await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+async def serve(spec_minifier):
+    def on_connection(reader, writer):
+        return serve_connection(reader, writer, spec_minifier)
+
+    if unix_socket_path:
+        server = await asyncio.start_unix_server(on_connection, path=unix_socket_path)
+        print(f'serving on {unix_socket_path}')
+    else:
+        server = await asyncio.start_server(on_connection, host, port)
+        print(f'serving on http://{host}:{port}')
+
+    watcher = asyncio.create_task(watch_specs(spec_minifier)) if watch_directory else None
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+
+def main(argv=None):
+    global host, port, unix_socket_path, watch_directory, watch_interval, watch_writes_output
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default=host)
+    parser.add_argument('--port', type=int, default=port)
+    parser.add_argument('--unix', dest='unix_socket_path', help='serve on a Unix socket instead')
+    parser.add_argument('--watch', dest='watch_directory', help='directory of specs to keep minified')
+    parser.add_argument('--watch-interval', type=float, default=watch_interval)
+    parser.add_argument('--write', action='store_true', help='also write the output files of watched specs')
+    parser.add_argument('--settings', help='JSON file of minifier settings')
+    args = parser.parse_args(argv)
+
+    host, port, unix_socket_path = args.host, args.port, args.unix_socket_path
+    watch_directory, watch_interval, watch_writes_output = args.watch_directory, args.watch_interval, args.write
+
+    settings = minifier.parse_arguments(['--settings', args.settings] if args.settings else [])
+    if watch_directory:
+        settings['input_filepath'] = watch_directory
+    try:
+        asyncio.run(serve(minifier.Minifier(**settings)))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 import json
 import os
+import hashlib
 import tiktoken
 from collections import defaultdict
 import string
@@ -8,6 +9,7 @@ import shutil
 from textwrap import dedent
 
 tokenizer = tiktoken.encoding_for_model("text-embedding-ada-002")
+token_count_cache = {}
 
 output_directory = 'minified_openapi_docs'
 
@@ -693,11 +695,17 @@ def count_tokens_in_directory(directory):
     return token_counts
 
 def tiktoken_len(text):
-    tokens = tokenizer.encode(
-        text,
-        disallowed_special=()
-    )
-    return len(tokens)
+    # distribute_endpoints counts the same endpoints on every pass, so counts are cached by content hash
+    key = hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+    token_count = token_count_cache.get(key)
+    if token_count is None:
+        tokens = tokenizer.encode(
+            text,
+            disallowed_special=()
+        )
+        token_count = len(tokens)
+        token_count_cache[key] = token_count
+    return token_count
 
 main()
 